@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Бенчмарки log_analyzer:
+#   stages    - синтетический лог, время, строк в секунду и пиковая память по этапам
+#               read_lines, prepare_stats, make_final_list, save_report; результаты дописываются в json-файл
+#   parser    - полный logpat + словарь (process_line) против извлечения только нужных полей (project_line),
+#               read_lines построчно против mmap
+#   aggregate - сбор статистики и make_final_list против make_final_list_np (numpy)
+#   gzip      - read_lines на gzip-логе с разными способами распаковки (GZIP_READER)
+
+import os
+import sys
+import time
+import gzip
+import json
+import random
+import resource
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+import multiprocessing
+
+import log_analyzer as la
+
+
+LINE_TEMPLATE = ('%s -  - [29/Jun/2017:%02d:%02d:%02d +0300] "%s %s HTTP/1.1" %s %d "-" '
+                 '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" '
+                 '"1498697422-2190034393-4708-9752759" "dc7161be3" %.3f\n')
+
+URL_TEMPLATES = ('/api/v2/banner/%d', '/api/v2/group/%d/statistic/sites/?date_type=day&date_from=2017-06-28',
+                 '/api/1/photo/%d/', '/export/appinstall_raw/2017-06-%02d/', '/api/v2/slot/%d/groups')
+
+STAGES = ('read_lines', 'prepare_stats', 'make_final_list', 'save_report')
+
+
+def generate_log(path, lines, urls, seed=1):
+    """Синтетический лог в формате ui_short: lines строк, около urls различных url (.gz - сжатый).
+
+    Популярность url неравномерная: 70% запросов - к небольшому числу "горячих" url (распределение Парето),
+    остальные - равномерно по всем urls; время ответа - экспоненциальное, у части url - с длинным хвостом.
+    """
+
+    rnd = random.Random(seed)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as log:
+        for _ in xrange(lines):
+            if rnd.random() < 0.7:
+                url_id = min(int(rnd.paretovariate(1.2)) - 1, urls - 1)
+            else:
+                url_id = rnd.randint(0, urls - 1)
+            request_time = rnd.expovariate(3.0)
+            if url_id % 17 == 0:
+                request_time *= 10
+            log.write(LINE_TEMPLATE % (
+                '1.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)),
+                rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59),
+                rnd.choice(('GET', 'GET', 'GET', 'POST')),
+                URL_TEMPLATES[url_id % len(URL_TEMPLATES)] % url_id,
+                rnd.choice(('200', '200', '200', '404', '500')),
+                rnd.randint(0, 100000),
+                request_time))
+
+
+def run_stage(stage, log_path, report_size):
+    """Выполнение этапа stage в отдельном процессе: отдельно измеряются время и рост пиковой памяти.
+    Входные данные этапа (разобранные строки, статистика, отчет) готовятся в том же процессе до замера"""
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_stage_process, args=(queue, stage, log_path, report_size))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _stage_process(queue, stage, log_path, report_size):
+    lines = stats = report = None
+    if stage != 'read_lines':
+        lines = list(la.read_lines(log_path, 0))
+    if stage in ('make_final_list', 'save_report'):
+        stats = la.prepare_stats(lines)
+        lines = None
+    if stage == 'save_report':
+        report = la.make_final_list(stats, report_size)
+        stats = None
+
+    rss_before = _peak_rss_kb()
+    started = time.time()
+    cpu_started = time.clock()
+    if stage == 'read_lines':
+        items = sum(1 for _ in la.read_lines(log_path, 0))
+    elif stage == 'prepare_stats':
+        items = len(lines)
+        la.prepare_stats(lines)
+    elif stage == 'make_final_list':
+        items = len(stats.data)
+        la.make_final_list(stats, report_size)
+    else:
+        items = len(report)
+        fd, report_path = tempfile.mkstemp(suffix='.html')
+        os.close(fd)
+        la.save_report(report, report_path)
+        os.unlink(report_path)
+    wall = time.time() - started
+    cpu = time.clock() - cpu_started
+    peak = _peak_rss_kb()
+
+    queue.put({
+        'stage': stage,
+        'items': items,
+        'wall_s': round(wall, 4),
+        'cpu_s': round(cpu, 4),
+        'items_per_s': round(items / wall, 1) if wall else None,
+        'peak_rss_kb': peak,
+        'rss_growth_kb': peak - rss_before,
+    })
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_stages(lines, urls, gz, report_size, output):
+    """Замер этапов на синтетическом логе, результат дописывается строкой json в output"""
+
+    fd, log_path = tempfile.mkstemp(prefix='nginx-bench-ui.log-', suffix='.gz' if gz else '')
+    os.close(fd)
+    try:
+        started = time.time()
+        generate_log(log_path, lines, urls)
+        print "synthetic log: %d lines, %d urls, %.1f MB%s (%.1f s)" % (
+            lines, urls, os.path.getsize(log_path) / 1048576.0, ' gzip' if gz else '', time.time() - started)
+
+        results = []
+        for stage in STAGES:
+            result = run_stage(stage, log_path, report_size)
+            results.append(result)
+            print "%-16s %10d items %8.2f s %12.0f items/s %10d KB peak %10d KB growth" % (
+                stage, result['items'], result['wall_s'], result['items_per_s'] or 0,
+                result['peak_rss_kb'], result['rss_growth_kb'])
+    finally:
+        os.unlink(log_path)
+
+    record = {
+        'time': datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'params': {'lines': lines, 'urls': urls, 'gzip': gz, 'report_size': report_size},
+        'stages': results,
+    }
+    with open(output, 'a') as out:
+        out.write(json.dumps(record) + '\n')
+    print "results appended to " + output
+    return record
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_parser(path, name, parse):
+    """Время разбора всех строк файла функцией parse"""
+
+    started = time.time()
+    parsed = 0
+    with open(path) as log:
+        for line in log:
+            if parse(line):
+                parsed += 1
+    elapsed = time.time() - started
+    print "%-24s %8.2f s %12.0f lines/s (%d parsed)" % (name, elapsed, parsed / elapsed, parsed)
+    return elapsed
+
+
+def bench_parsers(lines, urls):
+    """Сравнение process_line и project_line на синтетическом логе"""
+
+    fd, path = tempfile.mkstemp(prefix='nginx-bench-ui.log-')
+    os.close(fd)
+    try:
+        generate_log(path, lines, urls)
+        print "synthetic log: %d lines, %.1f MB" % (lines, os.path.getsize(path) / 1048576.0)
+
+        full = bench_parser(path, "process_line", la.process_line)
+        fast = bench_parser(path, "project_line", la.project_line)
+        bench_parser(path, "project_line(validate)", lambda line: la.project_line(line, validate=True))
+        print "speedup: %.2fx" % (full / fast)
+
+        # Чтение и разбор файла целиком: построчно и через mmap (PLAIN_READER)
+        results = {}
+        for reader in ('lines', 'mmap'):
+            started = time.time()
+            parsed = sum(1 for _ in la.read_lines(path, 0, readers=la.Readers(plain=reader, gzip='thread')))
+            results[reader] = time.time() - started
+            print "%-24s %8.2f s %12.0f lines/s" % ("read_lines(%s)" % reader, results[reader],
+                                                     parsed / results[reader])
+        print "speedup (mmap): %.2fx" % (results['lines'] / results['mmap'])
+    finally:
+        os.unlink(path)
+
+
+def bench_aggregate(rows, urls, report_size, seed=1):
+    """Сравнение make_final_list (с prepare_stats) и make_final_list_np на rows запросах к urls различным url"""
+
+    rnd = random.Random(seed)
+    url_ids = [rnd.randint(0, urls - 1) for _ in xrange(rows)]
+    times = [round(rnd.expovariate(3.0), 3) for _ in xrange(rows)]
+    url_names = ['/api/v2/banner/%d' % i for i in xrange(urls)]
+    parsed = [('GET %s HTTP/1.1' % url_names[url_id], '%.3f' % value) for url_id, value in zip(url_ids, times)]
+    print "synthetic data: %d rows, %d urls, report size %d" % (rows, urls, report_size)
+
+    started = time.time()
+    stats = la.prepare_stats(parsed)
+    prepared = time.time()
+    la.make_final_list(stats, report_size)
+    finished = time.time()
+    print "%-24s %8.2f s" % ("prepare_stats", prepared - started)
+    print "%-24s %8.2f s" % ("make_final_list", finished - prepared)
+    stream = finished - started
+
+    if la.np is None:
+        print "numpy is not installed"
+        return
+
+    ids_array = la.np.array(url_ids, dtype=la.np.uint32)
+    times_array = la.np.array(times, dtype=la.np.float32)
+    started = time.time()
+    la.make_final_list_np(url_names, ids_array, times_array, report_size)
+    vectorized = time.time() - started
+    print "%-24s %8.2f s" % ("make_final_list_np", vectorized)
+    print "speedup: %.2fx" % (stream / vectorized)
+
+
+def bench_gzip(lines, urls):
+    """Сравнение способов чтения gzip-лога: read_lines целиком (распаковка и разбор)"""
+
+    fd, path = tempfile.mkstemp(prefix='nginx-bench-ui.log-', suffix='.gz')
+    os.close(fd)
+    try:
+        generate_log(path, lines, urls)
+        print "synthetic log: %d lines, %.1f MB gzip" % (lines, os.path.getsize(path) / 1048576.0)
+
+        results = {}
+        for reader in ('simple', 'thread', 'process'):
+            started = time.time()
+            parsed = sum(1 for _ in la.read_lines(path, 0, readers=la.Readers(plain='lines', gzip=reader)))
+            results[reader] = time.time() - started
+            print "%-24s %8.2f s %12.0f lines/s" % ("read_lines(%s)" % reader, results[reader],
+                                                     parsed / results[reader])
+        print "speedup (thread): %.2fx" % (results['simple'] / results['thread'])
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", dest="bench", choices=("stages", "parser", "aggregate", "gzip"), default="stages")
+    parser.add_argument("--lines", dest="lines", type=int, default=1000000, help="lines in synthetic log")
+    parser.add_argument("--urls", dest="urls", type=int, default=10000, help="distinct urls")
+    parser.add_argument("--gzip", dest="gzip", action="store_true", help="gzipped synthetic log")
+    parser.add_argument("--report-size", dest="report_size", type=int, default=1000, help="report size")
+    parser.add_argument("--output", dest="output", default="bench_results.jsonl",
+                        help="file to append stage results to (one json per line)")
+    args = parser.parse_args()
+
+    # save_report читает шаблон report.html из текущего каталога
+    args.output = os.path.abspath(args.output)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if args.bench == "stages":
+        bench_stages(args.lines, args.urls, args.gzip, args.report_size, args.output)
+    elif args.bench == "parser":
+        bench_parsers(args.lines, args.urls)
+    elif args.bench == "gzip":
+        bench_gzip(args.lines, args.urls)
+    else:
+        bench_aggregate(args.lines, args.urls, args.report_size)
+    sys.exit(0)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Бенчмарки poker:
+#   wild       - best_wild_hand (гистограммы рангов и мастей) против best_wild_hand_reference (перебор замен)
+#                на руках из 7 карт с 0, 1 и 2 джокерами; результаты сверяются по значению hand_value
+#   throughput - рук в секунду для оценщиков на случайных руках из 5 и 7 карт и на граничных случаях
+#   verify     - проверка оценщика на всех 2598960 руках из 5 карт: порядок значений должен совпадать
+#                с независимой эталонной оценкой (reference_rank), число рук по категориям - с известным
+
+import sys
+import time
+import random
+import argparse
+import itertools
+from collections import defaultdict
+
+import poker
+
+
+DECK = [rank + suit for rank in poker.RANKS for suit in poker.SUITS]
+
+JOKER_SETS = ([], ['?B'], ['?B', '?R'])
+
+
+# Число рук из 5 карт по категориям и число различных по силе рук (классов)
+CATEGORY_HANDS = {8: 40, 7: 624, 6: 3744, 5: 5108, 4: 10200, 3: 54912, 2: 123552, 1: 1098240, 0: 1302540}
+CATEGORY_CLASSES = {8: 10, 7: 156, 6: 156, 5: 1277, 4: 10, 3: 858, 2: 858, 1: 2860, 0: 1277}
+
+VERIFY_CHUNK = 100000
+
+
+def _scalar(func):
+    return lambda hands: [func(cards) for cards in hands]
+
+
+def _averaged_rank(cards):
+    """Ключ сравнения из check_comb: категория и средние рангов двух частей hand_rank"""
+    rank = poker.mask_rank(sum(1 << card for card in cards))
+    return (rank[0], sum(rank[1]) / len(rank[1]) if rank[1] else 0, sum(rank[2]) / len(rank[2]) if rank[2] else 0)
+
+
+def _eval_batch(hands):
+    return poker.eval_batch(poker.np.array(hands, dtype=poker.np.uint8), positions=False).tolist()
+
+
+# Оценщики для throughput и verify: список рук (кортежи номеров карт) -> список значений, больше - сильнее
+EVALUATORS = {
+    'eval_cards': _scalar(poker.eval_cards),
+    'mask_value': _scalar(lambda cards: poker.mask_value(sum(1 << card for card in cards))),
+    'hand_value': _scalar(lambda cards: poker.hand_value([poker.card_name(card) for card in cards])),
+    'hand_rank': _scalar(lambda cards: poker.hand_rank([poker.card_name(card) for card in cards])),
+    'check_comb': _scalar(_averaged_rank),
+    'eval_batch': _eval_batch,
+}
+
+# Только для рук из 5 карт
+FIVE_CARD_EVALUATORS = ('hand_rank', 'check_comb')
+
+# Функции над строками карт для throughput (руки из 7 карт)
+HAND_FUNCTIONS = (
+    ('best_hand', poker.best_hand),
+    ('best_hand_reference', poker.best_hand_reference),
+    ('best_wild_hand', poker.best_wild_hand),
+)
+
+
+def reference_rank(cards):
+    """Эталонная оценка пяти карт (номера карт) без таблиц poker: кортеж, больше - сильнее"""
+
+    ranks = sorted((card % 13 + 2 for card in cards), reverse=True)
+    groups = sorted(((ranks.count(rank), rank) for rank in set(ranks)), reverse=True)
+    shape = [count for count, rank in groups]
+    order = tuple(rank for count, rank in groups)
+    is_flush = len(set(card // 13 for card in cards)) == 1
+    is_straight = len(groups) == 5 and (ranks[0] - ranks[4] == 4 or ranks == [14, 5, 4, 3, 2])
+    high = 5 if ranks == [14, 5, 4, 3, 2] else ranks[0]
+
+    if is_straight and is_flush:
+        return (8, high)
+    if shape == [4, 1]:
+        return (7,) + order
+    if shape == [3, 2]:
+        return (6,) + order
+    if is_flush:
+        return (5,) + order
+    if is_straight:
+        return (4, high)
+    if shape == [3, 1, 1]:
+        return (3,) + order
+    if shape == [2, 2, 1]:
+        return (2,) + order
+    if shape == [2, 1, 1, 1]:
+        return (1,) + order
+    return (0,) + order
+
+
+def verify(name):
+    """Проверка оценщика name на всех руках из 5 карт, возвращает число ошибок"""
+
+    evaluate = EVALUATORS[name]
+    classes = {}
+    categories = defaultdict(int)
+    conflicts = []
+    started = time.time()
+    hands = itertools.combinations(range(52), 5)
+    while True:
+        chunk = list(itertools.islice(hands, VERIFY_CHUNK))
+        if not chunk:
+            break
+        for cards, value in zip(chunk, evaluate(chunk)):
+            ref = reference_rank(cards)
+            categories[ref[0]] += 1
+            known = classes.setdefault(ref, value)
+            if known != value:
+                conflicts.append(cards)
+    elapsed = time.time() - started
+
+    # Одинаковые по эталону руки оцениваются одинаково, порядок классов совпадает
+    keys = sorted(classes)
+    inversions = [(a, b) for a, b in zip(keys, keys[1:]) if not classes[a] < classes[b]]
+    class_counts = defaultdict(int)
+    for key in keys:
+        class_counts[key[0]] += 1
+
+    errors = len(conflicts) + len(inversions)
+    if dict(categories) != CATEGORY_HANDS or dict(class_counts) != CATEGORY_CLASSES:
+        print "reference categories do not match known counts"
+        errors += 1
+    print "%s: %d hands, %d classes, %.1f s" % (name, sum(categories.values()), len(classes), elapsed)
+    print "conflicts (equal hands, different values): %d" % len(conflicts)
+    for cards in conflicts[:5]:
+        print "  " + " ".join(poker.card_name(card) for card in cards)
+    print "inversions (stronger class valued lower or equal): %d" % len(inversions)
+    for a, b in inversions[:5]:
+        print "  %s <= %s" % (b, a)
+    print "OK" if not errors else "FAILED"
+    return errors
+
+
+def adversarial_hands(count, seed=1):
+    """Руки из 7 карт на граничные случаи оценки: две тройки, три пары, каре с тройкой, стрит A-2-3-4-5,
+    стрит и флеш одновременно (и стрит-флеш внутри флеша), 7 карт одной масти"""
+
+    rnd = random.Random(seed)
+    hands = []
+    while len(hands) < count:
+        pattern = rnd.randint(0, 5)
+        ranks = rnd.sample(range(13), 4)
+        suited = 0
+        if pattern == 0:
+            ranks = ranks[:1] * 3 + ranks[1:2] * 3 + ranks[2:3]
+        elif pattern == 1:
+            ranks = ranks[:1] * 2 + ranks[1:2] * 2 + ranks[2:3] * 2 + ranks[3:4]
+        elif pattern == 2:
+            ranks = ranks[:1] * 4 + ranks[1:2] * 3
+        elif pattern == 3:
+            ranks = [12, 0, 1, 2, 3] + ranks[:2]
+        elif pattern == 4:
+            low = rnd.randint(0, 7)
+            ranks = range(low, low + 6) + ranks[:1]
+            suited = 5
+        else:
+            ranks = rnd.sample(range(13), 7)
+            suited = 7
+
+        suit = rnd.randint(0, 3)
+        cards = [suit * 13 + rank for rank in ranks[:suited]]
+        cards += [rnd.randint(0, 3) * 13 + rank for rank in ranks[suited:]]
+        if len(set(cards)) == 7:
+            rnd.shuffle(cards)
+            hands.append(tuple(cards))
+    return hands
+
+
+def bench_throughput(count):
+    """Рук в секунду для оценщиков и функций poker на случайных и граничных руках (таблицы уже заполнены)"""
+
+    rnd = random.Random(1)
+    sets = (
+        ('random 5', [tuple(rnd.sample(range(52), 5)) for _ in xrange(count)]),
+        ('random 7', [tuple(rnd.sample(range(52), 7)) for _ in xrange(count)]),
+        ('adversarial 7', adversarial_hands(count)),
+    )
+    for set_name, hands in sets:
+        print "%s, %d hands" % (set_name, len(hands))
+        for name in sorted(EVALUATORS):
+            if name in FIVE_CARD_EVALUATORS and len(hands[0]) != 5:
+                continue
+            if name == 'eval_batch' and poker.np is None:
+                continue
+            # Первый проход заполняет таблицы (RANK_TABLE, таблицы eval_batch) - замеряется второй
+            EVALUATORS[name](hands)
+            started = time.time()
+            EVALUATORS[name](hands)
+            elapsed = time.time() - started
+            print "  %-28s %8.3f s %12.0f hands/s" % (name, elapsed, len(hands) / elapsed)
+        if len(hands[0]) == 7:
+            named = [[poker.card_name(card) for card in cards] for cards in hands]
+            for name, func in HAND_FUNCTIONS:
+                # Перебор через hand_rank медленный - на части рук
+                part = named[:max(1, len(named) // 10)] if name.endswith('_reference') else named
+                started = time.time()
+                for hand in part:
+                    func(hand)
+                elapsed = time.time() - started
+                print "  %-28s %8.3f s %12.0f hands/s" % (name, elapsed, len(part) / elapsed)
+
+
+def random_hands(count, jokers, seed=1):
+    """count случайных рук из 7 карт, в каждой джокеры jokers"""
+
+    rnd = random.Random(seed)
+    return [rnd.sample(DECK, 7 - len(jokers)) + jokers for _ in xrange(count)]
+
+
+def bench_function(name, func, hands):
+    """Время вызова func на всех руках hands, возвращает (время, результаты)"""
+
+    started = time.time()
+    results = [func(hand) for hand in hands]
+    elapsed = time.time() - started
+    print "%-32s %8.3f s %12.0f hands/s" % (name, elapsed, len(hands) / elapsed)
+    return elapsed, results
+
+
+def bench_wild(count, reference_count):
+    """Сравнение best_wild_hand и best_wild_hand_reference для 0, 1 и 2 джокеров"""
+
+    for jokers in JOKER_SETS:
+        hands = random_hands(count, jokers)
+        print "%d jokers, %d hands" % (len(jokers), count)
+        fast, results = bench_function("best_wild_hand", poker.best_wild_hand, hands)
+
+        # Перебор медленный (до 26 * 26 * 21 комбинаций на руку) - для него меньше рук
+        slow, reference = bench_function("best_wild_hand_reference", poker.best_wild_hand_reference,
+                                         hands[:reference_count])
+        print "speedup: %.1fx" % ((slow / reference_count) / (fast / count))
+
+        # best_wild_hand_reference выбирает лучшую комбинацию через hand_rank, сравнение - по hand_value
+        better = sum(1 for hand, ref in zip(results, reference) if poker.hand_value(hand) > poker.hand_value(ref))
+        worse = sum(1 for hand, ref in zip(results, reference) if poker.hand_value(hand) < poker.hand_value(ref))
+        print "vs reference: %d better, %d worse of %d" % (better, worse, len(reference))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench", dest="bench", choices=("wild", "throughput", "verify"), default="wild")
+    parser.add_argument("--hands", dest="hands", type=int, default=20000, help="hands per set")
+    parser.add_argument("--reference-hands", dest="reference_hands", type=int, default=100,
+                        help="hands for the brute-force reference")
+    parser.add_argument("--evaluator", dest="evaluator", choices=sorted(EVALUATORS), default="eval_cards",
+                        help="evaluator to verify")
+    args = parser.parse_args()
+
+    if args.bench == "throughput":
+        bench_throughput(args.hands)
+    elif args.bench == "verify":
+        if args.evaluator == 'eval_batch' and poker.np is None:
+            print "numpy is not installed"
+            sys.exit(1)
+        sys.exit(1 if verify(args.evaluator) else 0)
+    else:
+        bench_wild(args.hands, min(args.reference_hands, args.hands))
+    sys.exit(0)
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# -----------------
+# Расчет эквити: вероятности выигрыша и ничьей для карманных карт нескольких игроков
+# при частично открытом борде.
+# Недостающие карты борда перебираются полностью (если вариантов не больше EXHAUSTIVE_LIMIT)
+# или разыгрываются случайно (Монте-Карло). Расчет делится на части: при переборе - по первой
+# карте добора, при Монте-Карло - по SAMPLE_CHUNK раздач со своим seed. Части считаются
+# в одном или нескольких процессах, результат не зависит от их числа.
+# Руки оцениваются пакетно (poker.eval_batch), без numpy - по таблицам (poker.eval_cards).
+#
+# Матрица эквити 169x169 классов стартовых рук (пары, одномастные, разномастные) для префлопа
+# или заданного флопа (equity_matrix, нужен numpy). На каждом варианте борда все 1326 пар карманных карт
+# оцениваются один раз, и эти значения используются для всех пар классов: для каждой руки число более
+# слабых и равных рук каждого класса находится поиском в отсортированных значениях класса, руки
+# с общими картами вычитаются. Эквити класса против класса - среднее по всем парам непересекающихся рук
+# и вариантам борда.
+# -----------------
+
+import sys
+import random
+import argparse
+import itertools
+import multiprocessing
+from collections import namedtuple
+
+import poker
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+EXHAUSTIVE_LIMIT = 2000000
+SAMPLE_CHUNK = 20000
+DEFAULT_TRIALS = 200000
+
+MATRIX_EXHAUSTIVE_LIMIT = 20000
+MATRIX_CHUNK = 100
+MATRIX_TRIALS = 2000
+
+# win - доля раздач, выигранных единолично, tie - доля раздач с разделом банка,
+# equity - ожидаемая доля банка
+PlayerEquity = namedtuple('PlayerEquity', ['win', 'tie', 'equity'])
+Equity = namedtuple('Equity', ['players', 'boards', 'exhaustive'])
+# classes - названия классов рук ('AA', 'AKs', 'AKo'), equity[i][j] - эквити класса i против класса j
+# (nan, если на этом борде у классов нет непересекающихся рук)
+EquityMatrix = namedtuple('EquityMatrix', ['classes', 'equity', 'boards', 'exhaustive'])
+
+
+def parse_cards(cards):
+    """Карты из строки ('AS KD') или списка строк -> номера карт"""
+    if isinstance(cards, basestring):
+        cards = cards.split()
+    try:
+        return [poker.CARD_INDEX[card.upper()] for card in cards]
+    except KeyError as e:
+        raise ValueError("Unknown card: %s" % e.args[0])
+
+
+def equity(hands, board=(), dead=(), trials=None, workers=1, seed=0):
+    """Эквити игроков с карманными картами hands при открытых картах борда board.
+
+    hands - список рук по 2 карты, board - 0-5 карт, dead - вышедшие из игры карты (строки или списки строк).
+    trials=None - полный перебор недостающих карт борда, если вариантов не больше EXHAUSTIVE_LIMIT,
+    иначе Монте-Карло на DEFAULT_TRIALS раздач; trials=N (N > 0) - всегда Монте-Карло на N раздач.
+    Результат Монте-Карло определяется seed.
+    """
+
+    hands = [parse_cards(hand) for hand in hands]
+    board = parse_cards(board)
+    dead = parse_cards(dead)
+    if len(hands) < 2:
+        raise ValueError("At least two players are required")
+    if any(len(hand) != 2 for hand in hands):
+        raise ValueError("Each player must have two hole cards")
+    if len(board) > 5:
+        raise ValueError("Board has at most five cards")
+    known = sum(hands, []) + board + dead
+    if len(set(known)) != len(known):
+        raise ValueError("Duplicate cards")
+    if trials is not None and trials <= 0:
+        raise ValueError("Number of trials must be positive")
+
+    deck = [card for card in range(52) if card not in set(known)]
+    missing = 5 - len(board)
+    if trials is None and _combinations(len(deck), missing) <= EXHAUSTIVE_LIMIT:
+        exhaustive = True
+        if missing:
+            tasks = [(hands, board, deck, missing, 'exhaustive', first) for first in range(len(deck) - missing + 1)]
+        else:
+            tasks = [(hands, board, deck, missing, 'exhaustive', None)]
+    else:
+        exhaustive = False
+        trials = DEFAULT_TRIALS if trials is None else trials
+        tasks = [(hands, board, deck, missing, 'sample', (seed, start, min(SAMPLE_CHUNK, trials - start)))
+                 for start in range(0, trials, SAMPLE_CHUNK)]
+
+    wins = [0] * len(hands)
+    ties = [0] * len(hands)
+    shares = [0.0] * len(hands)
+    boards = 0
+    for part in _run_tasks(_equity_chunk, tasks, workers):
+        part_wins, part_ties, part_shares, part_boards = part
+        wins = [a + b for a, b in zip(wins, part_wins)]
+        ties = [a + b for a, b in zip(ties, part_ties)]
+        shares = [a + b for a, b in zip(shares, part_shares)]
+        boards += part_boards
+
+    players = [PlayerEquity(win=float(win) / boards, tie=float(tie) / boards, equity=(win + share) / boards)
+               for win, tie, share in zip(wins, ties, shares)]
+    return Equity(players=players, boards=boards, exhaustive=exhaustive)
+
+
+def _combinations(n, k):
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+
+def _chunk_random(seed, start):
+    """Генератор случайных чисел части Монте-Карло, начинающейся с раздачи start.
+    Seed - целое число: строку Python 2 хеширует, и результат зависел бы от PYTHONHASHSEED"""
+    return random.Random(seed * 1000003 + start)
+
+
+def _run_tasks(func, tasks, workers):
+    """Результаты func по частям tasks по порядку (в пуле из workers процессов при workers > 1)"""
+
+    if workers <= 1 or len(tasks) < 2:
+        for task in tasks:
+            yield func(task)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        # imap сохраняет порядок частей - сумма долей банка не зависит от числа процессов
+        for part in pool.imap(func, tasks):
+            yield part
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _equity_chunk(task):
+    """Выигрыши, ничьи и доли банка игроков на части вариантов борда"""
+
+    hands, board, deck, missing, mode, params = task
+    if mode == 'exhaustive':
+        if params is None:
+            runouts = [()]
+        else:
+            runouts = [(deck[params],) + rest for rest in itertools.combinations(deck[params + 1:], missing - 1)]
+    else:
+        chunk_seed, start, count = params
+        rnd = _chunk_random(chunk_seed, start)
+        runouts = [rnd.sample(deck, missing) for _ in xrange(count)]
+
+    if np is not None:
+        return _count_batch(hands, board, runouts)
+    return _count_cards(hands, board, runouts)
+
+
+def _count_batch(hands, board, runouts):
+    """Подсчет для всех вариантов борда сразу средствами numpy"""
+
+    boards = np.empty((len(runouts), 5), dtype=np.uint8)
+    boards[:, :len(board)] = board
+    if len(board) < 5:
+        boards[:, len(board):] = np.array(runouts, dtype=np.uint8).reshape(len(runouts), -1)
+
+    values = np.empty((len(hands), len(runouts)), dtype=np.int32)
+    for player, hand in enumerate(hands):
+        cards = np.empty((len(runouts), 7), dtype=np.uint8)
+        cards[:, :2] = hand
+        cards[:, 2:] = boards
+        values[player] = poker.eval_batch(cards, positions=False)
+
+    winners = values == values.max(axis=0)
+    counts = winners.sum(axis=0)
+    wins = (winners & (counts == 1)).sum(axis=1)
+    ties = (winners & (counts > 1)).sum(axis=1)
+    shares = np.where(winners & (counts > 1), 1.0 / counts, 0.0).sum(axis=1)
+    return wins.tolist(), ties.tolist(), shares.tolist(), len(runouts)
+
+
+def _count_cards(hands, board, runouts):
+    """Подсчет по одному варианту борда через eval_cards"""
+
+    wins = [0] * len(hands)
+    ties = [0] * len(hands)
+    shares = [0.0] * len(hands)
+    for runout in runouts:
+        cards = board + list(runout)
+        values = [poker.eval_cards(hand + cards) for hand in hands]
+        best = max(values)
+        winners = [player for player, value in enumerate(values) if value == best]
+        if len(winners) == 1:
+            wins[winners[0]] += 1
+        else:
+            for player in winners:
+                ties[player] += 1
+                shares[player] += 1.0 / len(winners)
+    return wins, ties, shares, len(runouts)
+
+
+def hand_classes():
+    """169 классов стартовых рук: пары, одномастные и разномастные, от старших к младшим"""
+    ranks = poker.RANKS[::-1]
+    classes = []
+    for i, high in enumerate(ranks):
+        classes.append(high * 2)
+        for low in ranks[i + 1:]:
+            classes.extend((high + low + 's', high + low + 'o'))
+    return classes
+
+
+def hand_class(hand):
+    """Класс стартовой руки ('AS KS' -> 'AKs')"""
+    first, second = sorted(parse_cards(hand), key=lambda card: card % 13, reverse=True)
+    name = poker.RANKS[first % 13] + poker.RANKS[second % 13]
+    if first % 13 == second % 13:
+        return name
+    return name + ('s' if first // 13 == second // 13 else 'o')
+
+
+_matrix_tables = {}
+
+
+def _get_matrix_tables():
+    """Все 1326 пар карманных карт, упорядоченные по классам, и пары рук с общими картами"""
+    if not _matrix_tables:
+        classes = hand_classes()
+        index = dict((name, i) for i, name in enumerate(classes))
+        combos = sorted(itertools.combinations(range(52), 2),
+                        key=lambda combo: index[hand_class([poker.card_name(card) for card in combo])])
+        combo_class = np.array([index[hand_class([poker.card_name(card) for card in combo])] for combo in combos])
+
+        by_card = [[] for _ in range(52)]
+        for i, combo in enumerate(combos):
+            for card in combo:
+                by_card[card].append(i)
+        overlap = set()
+        for i, combo in enumerate(combos):
+            for card in combo:
+                overlap.update((i, j) for j in by_card[card])
+        overlap = np.array(sorted(overlap))
+
+        _matrix_tables.update({
+            'classes': classes,
+            'combos': np.array(combos, dtype=np.uint8),
+            'combo_class': combo_class,
+            'starts': np.searchsorted(combo_class, np.arange(len(classes))),
+            'overlap_a': overlap[:, 0],
+            'overlap_b': overlap[:, 1],
+        })
+    return _matrix_tables
+
+
+def equity_matrix(board=(), dead=(), trials=None, workers=1, seed=0):
+    """Матрица эквити 169x169 классов стартовых рук при открытых картах борда board (префлоп - без борда).
+
+    trials=None - полный перебор недостающих карт борда, если вариантов не больше MATRIX_EXHAUSTIVE_LIMIT
+    (флоп, терн, ривер), иначе Монте-Карло на MATRIX_TRIALS бордах; trials=N (N > 0) - Монте-Карло на N бордах.
+    """
+    if np is None:
+        raise RuntimeError("numpy is required for equity matrices")
+
+    board = parse_cards(board)
+    dead = parse_cards(dead)
+    if len(board) > 5:
+        raise ValueError("Board has at most five cards")
+    if len(set(board + dead)) != len(board + dead):
+        raise ValueError("Duplicate cards")
+    if trials is not None and trials <= 0:
+        raise ValueError("Number of trials must be positive")
+
+    deck = [card for card in range(52) if card not in set(board + dead)]
+    missing = 5 - len(board)
+    if trials is None and _combinations(len(deck), missing) <= MATRIX_EXHAUSTIVE_LIMIT:
+        exhaustive = True
+        runouts = list(itertools.combinations(deck, missing))
+        tasks = [(board, dead, runouts[start:start + MATRIX_CHUNK]) for start in range(0, len(runouts), MATRIX_CHUNK)]
+    else:
+        exhaustive = False
+        trials = MATRIX_TRIALS if trials is None else trials
+        tasks = []
+        for start in range(0, trials, MATRIX_CHUNK):
+            rnd = _chunk_random(seed, start)
+            tasks.append((board, dead, [rnd.sample(deck, missing) for _ in range(min(MATRIX_CHUNK, trials - start))]))
+
+    classes = _get_matrix_tables()['classes']
+    scores = np.zeros((len(classes), len(classes)))
+    pairs = np.zeros((len(classes), len(classes)))
+    boards = 0
+    for part_scores, part_pairs, part_boards in _run_tasks(_matrix_chunk, tasks, workers):
+        scores += part_scores
+        pairs += part_pairs
+        boards += part_boards
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix = scores / pairs
+    return EquityMatrix(classes=classes, equity=matrix, boards=boards, exhaustive=exhaustive)
+
+
+def _matrix_chunk(task):
+    """Суммы выигрышей (ничья - половина) и число пар рук по парам классов на части вариантов борда"""
+
+    board, dead, runouts = task
+    tables = _get_matrix_tables()
+    size = len(tables['classes'])
+    scores = np.zeros((size, size))
+    pairs = np.zeros((size, size))
+    for runout in runouts:
+        board_scores, board_pairs = _board_matrix(tables, board + list(runout), dead)
+        scores += board_scores
+        pairs += board_pairs
+    return scores, pairs, len(runouts)
+
+
+def _board_matrix(tables, board, dead):
+    """Выигрыши и число пар рук по парам классов на одном борде из 5 карт"""
+
+    combos = tables['combos']
+    combo_class = tables['combo_class']
+    size = len(tables['classes'])
+
+    # Значения всех пар карманных карт без карт борда - общие для всех пар классов
+    valid = ~np.in1d(combos, board + dead).reshape(combos.shape).any(axis=1)
+    cards = np.empty((valid.sum(), 7), dtype=np.uint8)
+    cards[:, :2] = combos[valid]
+    cards[:, 2:] = board
+    values = np.zeros(len(combos), dtype=np.int64)
+    values[valid] = poker.eval_batch(cards, positions=False)
+
+    # Для каждой руки и класса - число более слабых и равных рук класса (поиск в значениях, отсортированных
+    # по классу и значению), ничья - половина выигрыша
+    shift = 1 << 25
+    ordered = np.sort(combo_class[valid] * shift + values[valid])
+    bounds = np.searchsorted(ordered, np.arange(size + 1) * shift)
+    queries = np.arange(size)[None, :] * shift + values[:, None]
+    scores = (np.searchsorted(ordered, queries, 'left') + np.searchsorted(ordered, queries, 'right')) / 2.0
+    scores -= bounds[:-1]
+    pairs = np.tile(np.diff(bounds).astype(np.float64), (len(combos), 1))
+
+    # Руки с общими картами (и сама рука) не могут встретиться - вычитаются
+    a = tables['overlap_a']
+    b = tables['overlap_b']
+    both = valid[a] & valid[b]
+    a, b = a[both], b[both]
+    index = a * size + combo_class[b]
+    wins = (values[a] > values[b]) + 0.5 * (values[a] == values[b])
+    scores -= np.bincount(index, weights=wins, minlength=len(combos) * size).reshape(len(combos), size)
+    pairs -= np.bincount(index, minlength=len(combos) * size).reshape(len(combos), size)
+
+    scores[~valid] = 0
+    pairs[~valid] = 0
+    return np.add.reduceat(scores, tables['starts'], axis=0), np.add.reduceat(pairs, tables['starts'], axis=0)
+
+
+def write_matrix(result, output):
+    """Матрица эквити в csv: строка и столбец - классы рук, значение - эквити класса строки"""
+    output.write(",".join([""] + result.classes) + "\n")
+    for name, row in zip(result.classes, result.equity):
+        output.write(",".join([name] + ["%.4f" % value for value in row]) + "\n")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("hands", nargs="*", help="hole cards of each player, e.g. 'AS KS' 'QH QD'")
+    parser.add_argument("--board", dest="board", default="", help="board cards, e.g. '2C 7D 9H'")
+    parser.add_argument("--dead", dest="dead", default="", help="dead cards")
+    parser.add_argument("--trials", dest="trials", type=int, default=None,
+                        help="Monte Carlo trials (default: exhaustive when feasible)")
+    parser.add_argument("--workers", dest="workers", type=int, default=1, help="worker processes")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Monte Carlo seed")
+    parser.add_argument("--matrix", dest="matrix", action="store_true",
+                        help="169x169 hand class equity matrix for the board (csv)")
+    parser.add_argument("--output", dest="output", default=None, help="csv file for --matrix (default: stdout)")
+    args = parser.parse_args()
+
+    if args.matrix:
+        result = equity_matrix(args.board, args.dead, args.trials, args.workers, args.seed)
+        if args.output:
+            with open(args.output, 'w') as output:
+                write_matrix(result, output)
+        else:
+            write_matrix(result, sys.stdout)
+        sys.stderr.write("%s: %d boards\n" % ("exhaustive" if result.exhaustive else "monte carlo", result.boards))
+        sys.exit(0)
+    if len(args.hands) < 2:
+        parser.error("at least two hands are required")
+
+    result = equity(args.hands, args.board, args.dead, args.trials, args.workers, args.seed)
+    print "%s: %d boards" % ("exhaustive" if result.exhaustive else "monte carlo", result.boards)
+    for hand, player in zip(args.hands, result.players):
+        print "%-8s win %6.2f%%  tie %6.2f%%  equity %6.2f%%" % (
+            hand, player.win * 100, player.tie * 100, player.equity * 100)
+    sys.exit(0)
@@ -8,7 +8,15 @@
 #                     '$request_time';
 
 import os
+import io
+import time
 import gzip
+import math
+import mmap
+import zlib
+import threading
+import subprocess
+import Queue
 import datetime
 import re
 import sys
@@ -16,9 +24,31 @@ import json
 import ConfigParser
 import logging
 import argparse
+import functools
+import contextlib
+import cProfile
+import pstats
+import resource
+import heapq
+import bisect
+import itertools
+import multiprocessing
+import array
+import tempfile
 from collections import namedtuple
 from collections import defaultdict
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Совместимая с zlib реализация на ISA-L быстрее распаковывает gzip
+try:
+    from isal import isal_zlib as gzip_zlib
+except ImportError:
+    gzip_zlib = zlib
+
 # Конфиг по умолчанию
 config = {
     "REPORT_SIZE": 1000,
@@ -26,75 +56,727 @@ config = {
     "LOG_DIR": "./log",
     "FILE_PATTERN": 'nginx-access-ui.log',
     "SCRIPT_LOG": '',
-    "PARSING_RATIO": 0.95
+    "PARSING_RATIO": 0.95,
+    "WORKERS": 1,
+    "INCREMENTAL": '',
+    "STATE_DIR": "./state",
+    "COLUMNAR_DIR": "./columnar",
+    "AGGREGATOR": "stream",
+    "URL_STRIP_QUERY": '',
+    "URL_TEMPLATE_IDS": '',
+    "URL_MAX_KEYS": 0,
+    "REPORT_FORMAT": "html",
+    "REPORT_PAGE_SIZE": 0,
+    "GZIP_READER": "thread",
+    "DIMENSIONS": '',
+    "FOLLOW_INTERVAL": 60,
+    "FOLLOW_WINDOWS": "5,60",
+    "QUANTILE_MODE": "hybrid",
+    "QUANTILE_ACCURACY": 0.01,
+    "PLAIN_READER": "lines",
+    "PROFILE": '',
+    "PROFILE_SAMPLE": 0
 }
 
+# Размер пачки строк, которую gzip-лог отдает одному процессу-обработчику
+WORKER_BATCH_LINES = 50000
+
+# Чтение gzip: размер блока сжатых данных и число распакованных блоков в очереди между потоками
+GZIP_BLOCK_SIZE = 1 << 20
+GZIP_QUEUE_BLOCKS = 8
+
+# Режим слежения за логом: пауза между проверками файла, когда новых строк нет (секунды)
+FOLLOW_POLL_INTERVAL = 1.0
+
+# Число функций с наибольшим cumtime в сводке cProfile (PROFILE_SAMPLE)
+PROFILE_TOP = 25
+
+# Кеш списков файлов с датой в имени (логи, сводные данные) - относительно STATE_DIR
+DIR_INDEX_FILE = os.path.join('index', 'dirs.json')
+
 # Используемые custom типы данных
 LastData = namedtuple('last', 'filename date')
 StatsData = namedtuple('stats', 'data requests_total time_total')
+UrlRules = namedtuple('UrlRules', 'strip_query template_ids max_keys')
+Readers = namedtuple('Readers', 'plain gzip')
+
+# Способы чтения логов, если они не заданы (PLAIN_READER и GZIP_READER по умолчанию)
+DEFAULT_READERS = Readers(plain='lines', gzip='thread')
 
 # Шаблон парсинга строки
 logpats = r'(\S+) (\S+)  (\S+) \[(.*?)\] "(.*?)" (\d+) (\d+) "(\S+)" "(.*?)" "(\S+)" "(\S+)" "(\S+)" ([\d.]+)'
 logpat = re.compile(logpats)
 
+# Разбор plain-лога через mmap (PLAIN_READER = mmap): строка с группами request и request_time
+# или, во второй ветке, строка, которую выражение не разобрало. Первая ветка проверяет только начало и конец
+# строки - mmap_lines принимает ее, если в строке 12 кавычек, как у ui_short (та же проверка, что в _fast_request_fields)
+MMAP_LINE = re.compile(r'[^"\n]*"([^"\n]*)" [^\n]*" (\d+(?:\.\d*)?)[\t\r]*\n|[^\n]*\n')
+
+# Поля строки лога (в порядке групп logpat)
+COLNAMES = ('remote_addr', 'remote_user', 'http_x_real_ip', 'time_local', 'request', 'status', 'body_bytes_sent',
+            'http_referer', 'http_user_agent', 'http_x_forwarded_for', 'http_x_request_id', 'http_x_rb_user',
+            'request_time')
+COLGROUPS = dict((name, i + 1) for i, name in enumerate(COLNAMES))
+
+# Поля, которые нужны для сбора статистики по url
+STATS_FIELDS = ('request', 'request_time')
+
+# Нормализация url: числовые и UUID сегменты пути заменяются шаблонами,
+# url сверх лимита URL_MAX_KEYS собираются в OTHER_URL
+NUMERIC_SEGMENT = re.compile(r'(?<=/)\d+(?=/|$)')
+UUID_SEGMENT = re.compile(r'(?<=/)[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)')
+OTHER_URL = '<other>'
+
+# Дополнительные измерения отчета (DIMENSIONS): имя -> (поле строки лога, значение измерения по значению поля)
+DIMENSION_FIELDS = {
+    'hour': ('time_local', lambda value: value[12:14]),
+    'status': ('status', lambda value: value[:1] + 'xx'),
+    'http_x_rb_user': ('http_x_rb_user', lambda value: value),
+}
+
+# Квантили времени ответа, которые добавляются в отчет с измерениями
+REPORT_QUANTILES = (('time_p95', 0.95), ('time_p99', 0.99))
+
+# Колоночный формат: поля строки и колонки (имя, тип array, тип numpy)
+COLUMNAR_FIELDS = ('request', 'request_time', 'status')
+COLUMNS = (('url_id', 'I', '<u4'), ('request_time', 'f', '<f4'), ('status', 'H', '<u2'))
+COLUMNAR_BLOCK_ROWS = 65536
+
+# Параметры оценки медианы: до SKETCH_EXACT_LIMIT значений на url хранятся точно,
+# дальше - лог-гистограмма с относительной погрешностью SKETCH_ACCURACY.
+# Меняются set_quantile_mode по QUANTILE_MODE и QUANTILE_ACCURACY
+QUANTILE_MODE = 'hybrid'
+SKETCH_EXACT_LIMIT = 64
+SKETCH_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+
+# Режимы оценки квантилей: сколько значений на url хранится точно до перехода к гистограмме
+# (exact - все, hybrid - 64, sketch - ни одного, память на url O(1))
+QUANTILE_EXACT_LIMITS = {'exact': sys.maxint, 'hybrid': 64, 'sketch': 0}
+
+# Погрешность гистограмм и режим оценки в state-файлах, записанных до появления QUANTILE_ACCURACY и QUANTILE_MODE
+STATE_DEFAULT_ACCURACY = 0.01
+STATE_DEFAULT_MODE = 'hybrid'
+
+
+class QuantileSketch(object):
+    """Оценка квантилей с ограниченной памятью.
+
+    Пока значений не больше SKETCH_EXACT_LIMIT, они хранятся списком и квантиль считается точно.
+    Затем значения раскладываются по логарифмическим корзинам (индекс корзины - ceil(log_gamma(x))),
+    число корзин ограничено диапазоном значений, а не их количеством.
+    """
+
+    __slots__ = ('count', 'values', 'buckets', 'zeros')
+
+    def __init__(self):
+        self.count = 0
+        self.values = []
+        self.buckets = None
+        self.zeros = 0
+
+    def add(self, value):
+        self.count += 1
+        if self.buckets is None:
+            self.values.append(value)
+            if len(self.values) > SKETCH_EXACT_LIMIT:
+                self._collapse()
+        else:
+            self._add_bucket(value, 1)
+
+    def merge(self, other):
+        """Объединение с другим скетчем (например, из другого куска лога)"""
+
+        self.count += other.count
+        if self.buckets is None and other.buckets is None \
+                and len(self.values) + len(other.values) <= SKETCH_EXACT_LIMIT:
+            self.values.extend(other.values)
+            return self
+
+        if self.buckets is None:
+            self._collapse()
+        for value in other.values:
+            self._add_bucket(value, 1)
+        if other.buckets is not None:
+            self.zeros += other.zeros
+            for idx, cnt in other.buckets.iteritems():
+                self.buckets[idx] = self.buckets.get(idx, 0) + cnt
+        return self
+
+    def __reduce__(self):
+        return _sketch_from_state, (self.to_state(),)
+
+    def to_state(self):
+        """Компактное представление для сериализации"""
+
+        return self.count, self.values, self.buckets, self.zeros
+
+    def quantile(self, q):
+        """Квантиль q (0..1); для q=0.5 в точном режиме совпадает с median()"""
+
+        if self.count < 1:
+            return 0.0
+
+        if self.buckets is None:
+            values = sorted(self.values)
+            pos = q * (len(values) - 1)
+            lo = int(math.floor(pos))
+            hi = int(math.ceil(pos))
+            frac = pos - lo
+            return values[lo] * (1 - frac) + values[hi] * frac
+
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if rank < seen:
+                return 2 * SKETCH_GAMMA ** idx / (SKETCH_GAMMA + 1)
+        return 2 * SKETCH_GAMMA ** max(self.buckets) / (SKETCH_GAMMA + 1)
+
+    def error_bound(self, estimate):
+        """Граница абсолютной погрешности оценки квантиля estimate (0 - если значения хранятся точно)"""
+
+        if self.buckets is None:
+            return 0.0
+        return estimate * SKETCH_ACCURACY / (1 - SKETCH_ACCURACY)
+
+    def _collapse(self):
+        """Переход из точного режима в гистограмму"""
+
+        self.buckets = {}
+        for value in self.values:
+            self._add_bucket(value, 1)
+        self.values = []
+
+    def _add_bucket(self, value, cnt):
+        if value <= 0:
+            self.zeros += cnt
+        else:
+            idx = int(math.ceil(math.log(value) / SKETCH_LOG_GAMMA))
+            self.buckets[idx] = self.buckets.get(idx, 0) + cnt
+
+
+class UrlStats(object):
+    """Накопитель показателей по одному url: количество, сумма, максимум и скетч для медианы"""
+
+    __slots__ = ('count', 'time_sum', 'time_max', 'times')
+
+    def __init__(self):
+        self.count = 0
+        self.time_sum = 0.0
+        self.time_max = 0.0
+        self.times = QuantileSketch()
+
+    def add(self, time):
+        self.count += 1
+        self.time_sum += time
+        if time > self.time_max:
+            self.time_max = time
+        self.times.add(time)
+
+    def merge(self, other):
+        self.count += other.count
+        self.time_sum += other.time_sum
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        self.times.merge(other.times)
+        return self
+
+    def median(self):
+        return self.times.quantile(0.5)
+
+    def __reduce__(self):
+        return _url_stats_from_state, (self.to_state(),)
+
+    def to_state(self):
+        """Компактное представление для сериализации"""
+
+        return self.count, self.time_sum, self.time_max, self.times.to_state()
+
+
+def set_quantile_mode(mode, accuracy=0.01):
+    """Выбор режима оценки квантилей (QUANTILE_EXACT_LIMITS) и относительной погрешности гистограммы.
+    Действует на все скетчи, в том числе в дочерних процессах, созданных после вызова"""
+
+    global QUANTILE_MODE, SKETCH_EXACT_LIMIT, SKETCH_ACCURACY, SKETCH_GAMMA, SKETCH_LOG_GAMMA
+
+    if mode not in QUANTILE_EXACT_LIMITS:
+        raise ValueError("Unknown quantile mode: %s" % mode)
+    if not 0 < accuracy < 1:
+        raise ValueError("Quantile accuracy must be between 0 and 1: %s" % accuracy)
+
+    QUANTILE_MODE = mode
+    SKETCH_EXACT_LIMIT = QUANTILE_EXACT_LIMITS[mode]
+    SKETCH_ACCURACY = accuracy
+    SKETCH_GAMMA = (1 + accuracy) / (1 - accuracy)
+    SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+
+
+def _sketch_from_state(state):
+    sketch = QuantileSketch()
+    sketch.count, sketch.values, sketch.buckets, sketch.zeros = state
+    return sketch
+
+
+def _url_stats_from_state(state):
+    url_stats = UrlStats()
+    url_stats.count, url_stats.time_sum, url_stats.time_max, times = state
+    url_stats.times = _sketch_from_state(times)
+    return url_stats
+
 
 def main(config):
 
     # Определяем файл с последней датой
-    latest = get_latest_file(config["LOG_DIR"], config["FILE_PATTERN"])
+    latest = get_latest_file(config["LOG_DIR"], config["FILE_PATTERN"], dir_index_path(config))
     if latest.filename:
 
         # Готовим отчет
         log_path = os.path.join(config["LOG_DIR"], latest.filename)
-        report_path = os.path.join(config["REPORT_DIR"], 'report-' + latest.date + '.html')
+        report_path = report_file_path(config["REPORT_DIR"], latest.date, config["REPORT_FORMAT"])
         if not os.path.exists(config["REPORT_DIR"]):
             os.makedirs(config["REPORT_DIR"])
 
-        if not report_exists(report_path):
+        incremental = config_flag(config["INCREMENTAL"])
+        if incremental or not report_exists(report_path):
             logging.info("Processing path: " + log_path)
 
-            # Собираем сводную информацию по всем запросам
-            stats_data = prepare_stats(read_lines(log_path, config["PARSING_RATIO"]))
-
-            # Расчитываем показатели и создаем финальный список для отчета
-            report = make_final_list(stats_data, int(config["REPORT_SIZE"]))
+            # Замеры этапов; с PROFILE они пишутся в json-сводку
+            profiler = Profiler()
+            url_rules = url_rules_from_config(config)
+            dimensions = dimensions_from_config(config)
+            readers = readers_from_config(config)
+            if config["AGGREGATOR"] == "numpy" and not incremental and not dimensions:
+                # Расчет по колонкам лога средствами numpy (колоночный файл создается при необходимости)
+                col_path = os.path.join(config["COLUMNAR_DIR"], latest.filename + '.col')
+                if not os.path.exists(col_path):
+                    with profiler.stage('convert_log'):
+                        convert_log(log_path, col_path, float(config["PARSING_RATIO"]), url_rules, readers)
+                with profiler.stage('load_columns') as stage:
+                    columns = load_columns(col_path)
+                    stage['items'] = len(columns['url_id'])
+                with profiler.stage('make_final_list') as stage:
+                    report = make_final_list_np(columns['urls'], columns['url_id'], columns['request_time'],
+                                                int(config["REPORT_SIZE"]))
+                    stage['items'] = len(report)
+
+                # Сводные данные за день - в STATE_DIR, как и при потоковом сборе (для --rollup)
+                with profiler.stage('save_state') as stage:
+                    stage['items'] = save_columns_state(columns, log_path,
+                                                        state_file_path(config["STATE_DIR"], latest.filename),
+                                                        url_rules)
+            else:
+                # Собираем сводную информацию по всем запросам. Сводные данные за день сохраняются в STATE_DIR:
+                # по ним дочитываются новые строки (INCREMENTAL) и строятся отчеты за период (--rollup).
+                # Чтение, разбор и агрегация идут в одном проходе, поэтому замеряются одним этапом
+                state_path = state_file_path(config["STATE_DIR"], latest.filename)
+                with profiler.stage('prepare_stats') as stage:
+                    stats_data = prepare_stats_incremental(log_path, state_path, float(config["PARSING_RATIO"]),
+                                                           int(config["WORKERS"]), url_rules, dimensions, readers)
+                    stage['items'] = stats_data.requests_total
+
+                # Расчитываем показатели, строки отчета формируются по мере записи.
+                # При профилировании строки собираются заранее, чтобы замерить расчет отдельно от записи
+                report = iter_final_list(stats_data, int(config["REPORT_SIZE"]), dimensions)
+                if config["PROFILE"]:
+                    with profiler.stage('make_final_list') as stage:
+                        report = list(report)
+                        stage['items'] = len(report)
 
             # Запись отчета в файл
-            save_report(report, report_path)
+            with profiler.stage('save_report'):
+                write_report(report, report_path, config["REPORT_FORMAT"], int(config["REPORT_PAGE_SIZE"]))
+
+            if config["PROFILE"]:
+                summary = {'log': log_path, 'stages': profiler.stages}
+                if int(config["PROFILE_SAMPLE"]) > 0:
+                    summary['sample'] = profile_sample(log_path, int(config["PROFILE_SAMPLE"]), url_rules, dimensions,
+                                                       readers)
+                write_profile(config["PROFILE"], summary)
 
     else:
         logging.error("No log file")
 
 
-def get_latest_file(logdir, file_pattern):
+def main_rollup(config, period, date=None):
+    """Отчет за неделю или месяц по сохраненным сводным данным за дни, без чтения логов"""
+
+    days = find_state_files(config["STATE_DIR"], config["FILE_PATTERN"], dir_index_path(config))
+    if not days:
+        logging.error("No daily aggregates in " + config["STATE_DIR"])
+        return None
+
+    if date is None:
+        date = max(days)
+    else:
+        date = datetime.datetime.strptime(date, "%Y%m%d")
+    start, end, name = rollup_period(period, date)
+
+    state_paths = [days[day] for day in sorted(days) if start <= day <= end]
+    logging.info("Rollup %s: %s of %s days have aggregates" % (name, len(state_paths), (end - start).days + 1))
+    if not state_paths:
+        logging.error("No daily aggregates for " + name)
+        return None
+
+    dimensions = dimensions_from_config(config)
+    stats_data = rollup_stats(state_paths, int(config["URL_MAX_KEYS"]), dimensions, url_rules_from_config(config))
+    report = iter_final_list(stats_data, int(config["REPORT_SIZE"]), dimensions)
+
+    if not os.path.exists(config["REPORT_DIR"]):
+        os.makedirs(config["REPORT_DIR"])
+    return write_report(report, report_file_path(config["REPORT_DIR"], name, config["REPORT_FORMAT"]),
+                        config["REPORT_FORMAT"], int(config["REPORT_PAGE_SIZE"]))
+
+
+def main_convert(config):
+    """Конвертация лога с последней датой в колоночный формат (COLUMNAR_DIR/<имя лога>.col)"""
+
+    latest = get_latest_file(config["LOG_DIR"], config["FILE_PATTERN"], dir_index_path(config))
+    if not latest.filename:
+        logging.error("No log file")
+        return None
+
+    log_path = os.path.join(config["LOG_DIR"], latest.filename)
+    col_path = os.path.join(config["COLUMNAR_DIR"], latest.filename + '.col')
+    if os.path.exists(col_path):
+        logging.info("Columnar file already exists ... exit")
+        return col_path
+
+    logging.info("Converting path: " + log_path)
+    return convert_log(log_path, col_path, float(config["PARSING_RATIO"]), url_rules_from_config(config),
+                       readers_from_config(config))
+
+
+def main_follow(config, stop=None):
+    """Слежение за логом с последней датой (как tail -f).
+
+    Новые строки раскладываются по минутам времени лога, раз в FOLLOW_INTERVAL секунд пишутся отчеты
+    за скользящие окна FOLLOW_WINDOWS (минуты): report-live-5m.html, report-live-60m.html, ...
+    Ротация отслеживается по смене inode или усечению файла, а также по появлению лога с более поздней датой.
+    stop - threading.Event для остановки цикла (по умолчанию работает до прерывания).
+    """
+
+    latest = get_latest_file(config["LOG_DIR"], config["FILE_PATTERN"], dir_index_path(config))
+    if not latest.filename:
+        logging.error("No log file")
+        return None
+    if latest.filename.endswith(".gz"):
+        logging.error("Follow mode needs a plain log: " + latest.filename)
+        return None
+
+    if stop is None:
+        stop = threading.Event()
+    windows = sorted(int(minutes) for minutes in str(config["FOLLOW_WINDOWS"]).split(',') if minutes.strip())
+    interval = float(config["FOLLOW_INTERVAL"])
+    url_rules = url_rules_from_config(config)
+    dimensions = dimensions_from_config(config)
+    fields = stats_fields(dimensions) + ('time_local',)
+    if not os.path.exists(config["REPORT_DIR"]):
+        os.makedirs(config["REPORT_DIR"])
+
+    follower = LogFollower(os.path.join(config["LOG_DIR"], latest.filename))
+    rolling = RollingStats(windows[-1], url_rules, dimensions)
+    counters = {'total': 0, 'processed': 0}
+    next_report = time.time() + interval
+    logging.info("Following path: " + follower.log_path)
+    try:
+        while not stop.is_set():
+            lines = follower.read_lines()
+            rolling.add(parse_lines(lines, counters, fields))
+
+            if not lines:
+                # Лог за новую дату: старый файл дочитывается, новый читается с начала
+                latest = get_latest_file(config["LOG_DIR"], config["FILE_PATTERN"], dir_index_path(config))
+                log_path = os.path.join(config["LOG_DIR"], latest.filename or '')
+                if latest.filename and not latest.filename.endswith(".gz") and log_path != follower.log_path:
+                    logging.info("Following path: " + log_path)
+                    rolling.add(parse_lines(follower.switch(log_path), counters, fields))
+
+            if time.time() >= next_report:
+                write_live_reports(rolling, windows, config, dimensions)
+                logging.info("%s of %s lines processed" % (counters['processed'], counters['total']))
+                next_report = time.time() + interval
+
+            if not lines:
+                stop.wait(FOLLOW_POLL_INTERVAL)
+    finally:
+        follower.close()
+
+    return write_live_reports(rolling, windows, config, dimensions)
+
+
+def write_live_reports(rolling, windows, config, dimensions=()):
+    """Запись отчетов за скользящие окна (report-live-<минуты>m), каждый - через .tmp + rename"""
+
+    report_paths = []
+    for minutes in windows:
+        report = iter_final_list(rolling.window(minutes), int(config["REPORT_SIZE"]), dimensions)
+        report_path = report_file_path(config["REPORT_DIR"], 'live-%dm' % minutes, config["REPORT_FORMAT"])
+        report_paths.append(write_report(report, report_path, config["REPORT_FORMAT"]))
+    return report_paths
+
+
+class Profiler(object):
+    """Замеры этапов запуска: время, процессорное время (вместе с дочерними процессами),
+    число обработанных элементов и память: peak_rss_kb - пиковый RSS процесса с начала работы (накопительный),
+    rss_growth_kb - на сколько этап поднял этот пик (память самого этапа, если она больше прежнего пика)"""
+
+    def __init__(self):
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Замер блока with; в выданный словарь можно записать число элементов ('items')"""
+
+        result = {'stage': name, 'items': None}
+        started = time.time()
+        cpu_started = _cpu_time()
+        rss_before = _peak_rss_kb()
+        try:
+            yield result
+        finally:
+            wall = time.time() - started
+            result['wall_s'] = round(wall, 4)
+            result['cpu_s'] = round(_cpu_time() - cpu_started, 4)
+            result['items_per_s'] = round(result['items'] / wall, 1) if result['items'] and wall else None
+            result['peak_rss_kb'] = _peak_rss_kb()
+            result['rss_growth_kb'] = result['peak_rss_kb'] - rss_before
+            self.stages.append(result)
+            logging.info("Stage %s: %.2f s wall, %.2f s cpu, %s items, %s KB rss growth" % (
+                name, wall, result['cpu_s'], result['items'], result['rss_growth_kb']))
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss_kb():
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def profile_sample(log_path, sample_lines, url_rules=None, dimensions=(), readers=None):
+    """Первые sample_lines строк лога: чтение (с распаковкой), разбор и агрегация замеряются по отдельности,
+    затем весь разбор выборки выполняется под cProfile - в сводку попадают PROFILE_TOP функций по cumtime"""
+
+    profiler = Profiler()
+    fields = stats_fields(dimensions)
+
+    with profiler.stage('read_lines') as stage:
+        log = open_log(log_path, (readers or DEFAULT_READERS).gzip)
+        try:
+            raw_lines = list(itertools.islice(log, sample_lines))
+        finally:
+            log.close()
+        stage['items'] = len(raw_lines)
+
+    with profiler.stage('process_line') as stage:
+        parsed = [parsed_line for parsed_line in (project_line(line, fields) for line in raw_lines) if parsed_line]
+        stage['items'] = len(raw_lines)
+
+    with profiler.stage('prepare_stats') as stage:
+        prepare_stats(parsed, url_rules, dimensions)
+        stage['items'] = len(parsed)
+
+    profile = cProfile.Profile()
+    profile.enable()
+    prepare_stats(parse_lines(raw_lines, {'total': 0, 'processed': 0}, fields), url_rules, dimensions)
+    profile.disable()
+
+    functions = sorted(pstats.Stats(profile).stats.iteritems(), key=lambda item: item[1][3], reverse=True)
+    return {
+        'lines': len(raw_lines),
+        'stages': profiler.stages,
+        'profile': [{'function': '%s:%d(%s)' % func, 'ncalls': ncalls, 'tottime': round(tottime, 4),
+                     'cumtime': round(cumtime, 4)}
+                    for func, (_, ncalls, tottime, cumtime, _) in functions[:PROFILE_TOP]]
+    }
+
+
+def write_profile(profile_path, summary):
+    """Запись json-сводки замеров через .tmp + rename"""
+
+    summary = dict(summary, time=datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
+    dirname = os.path.dirname(profile_path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(profile_path + '.tmp', 'w') as profile_file:
+        json.dump(summary, profile_file, indent=2)
+    os.rename(profile_path + '.tmp', profile_path)
+    logging.info("Profile written to " + profile_path)
+    return profile_path
+
+
+def state_file_path(state_dir, log_filename):
+    """Путь к файлу сводных данных лога"""
+
+    return os.path.join(state_dir, log_filename + '.state.json.gz')
+
+
+def find_state_files(state_dir, file_pattern, index_path=None):
+    """Файлы сводных данных за дни: {дата: путь}; для одной даты берется последний измененный файл"""
+
+    days = {}
+    if not os.path.exists(state_dir):
+        return days
+
+    state_pat = re.compile(r'^' + re.escape(file_pattern) + r'-(\d{8})(\.gz)?\.state\.json\.gz$')
+    for date_str, name in scan_dated_files(state_dir, state_pat, index_path):
+        day = datetime.datetime.strptime(date_str, "%Y%m%d")
+        path = os.path.join(state_dir, name)
+        if day not in days or os.path.getmtime(path) > os.path.getmtime(days[day]):
+            days[day] = path
+
+    return days
+
+
+def rollup_period(period, date):
+    """Границы (start, end) и имя периода: календарная неделя (ISO) или месяц, содержащие date"""
+
+    if period == 'week':
+        start = date - datetime.timedelta(days=date.weekday())
+        end = start + datetime.timedelta(days=6)
+        year, week, _ = date.isocalendar()
+        return start, end, '%d.W%02d' % (year, week)
+
+    if period == 'month':
+        start = date.replace(day=1)
+        next_month = (start + datetime.timedelta(days=32)).replace(day=1)
+        return start, next_month - datetime.timedelta(days=1), start.strftime("%Y.%m")
+
+    raise ValueError("Unknown rollup period: %s" % period)
+
+
+def rollup_stats(state_paths, max_keys=0, dimensions=(), url_rules=None):
+    """Объединение сводных данных из нескольких state-файлов.
+    Файлы, собранные с другим набором измерений, правилами url или погрешностью квантилей, пропускаются"""
+
+    stats = StatsData(data=defaultdict(UrlStats), requests_total=0, time_total=0.0)
+    for state_path in state_paths:
+        state = load_state(state_path)
+        if not state_compatible(state, dimensions, url_rules):
+            logging.warning("Skipping %s: aggregated with other dimensions, url rules, quantile mode or accuracy"
+                            % state_path)
+            continue
+        stats = merge_stats(stats, state['stats'], max_keys)
+    return stats
+
+
+def get_latest_file(logdir, file_pattern, index_path=None):
     """Поиск файла с последней датой """
 
-    latest_date = datetime.datetime.utcfromtimestamp(0)
-    latest = LastData(filename=None, date=None)
+    latest = get_latest_files(logdir, file_pattern, 1, index_path)
+    if latest:
+        return latest[0]
+    return LastData(filename=None, date=None)
 
-    if os.path.exists(logdir):
-        for file in os.listdir(logdir):
 
-            # Обработка названия файла
-            groups = re.match(r'^' + file_pattern + '-([\d]{8})([\.gz]?)', file)
-            if groups:
-                parts = groups.groups()
-                date_str = parts[0]
+def get_latest_files(logdir, file_pattern, count, index_path=None):
+    """count файлов лога с последними датами (LastData), от новых к старым"""
 
-                # Преобразуем дату из имени файла
-                try:
-                    tm = datetime.datetime.strptime(date_str, "%Y%m%d")
-                except:
-                    logging.exception("Date format is invalid")
+    if not os.path.exists(logdir):
+        logging.error("Log directory doesn't exist")
+        return []
 
-                # Сохраняем имя файла с последней датой
-                if tm > latest_date:
-                    latest = LastData(filename=file, date=tm.strftime("%Y.%m.%d"))
+    files = scan_dated_files(logdir, log_file_pat(file_pattern), index_path)
+    return [_last_data(date_str, name) for date_str, name in reversed(files[-count:] if count > 0 else [])]
 
-    else:
+
+def find_log_files(logdir, file_pattern, start, end, index_path=None):
+    """Файлы лога (LastData) с датами от start до end (datetime, включительно), по возрастанию даты"""
+
+    if not os.path.exists(logdir):
         logging.error("Log directory doesn't exist")
+        return []
+
+    files = scan_dated_files(logdir, log_file_pat(file_pattern), index_path)
+    lo = bisect.bisect_left(files, (start.strftime("%Y%m%d"),))
+    hi = bisect.bisect_left(files, ((end + datetime.timedelta(days=1)).strftime("%Y%m%d"),))
+    return [_last_data(date_str, name) for date_str, name in files[lo:hi]]
+
+
+def log_file_pat(file_pattern):
+    """Шаблон имени файла лога: <FILE_PATTERN>-YYYYMMDD или <FILE_PATTERN>-YYYYMMDD.gz"""
 
-    return latest
+    return re.compile(r'^' + re.escape(file_pattern) + r'-(\d{8})(\.gz)?$')
+
+
+def _last_data(date_str, name):
+    return LastData(filename=name, date='%s.%s.%s' % (date_str[:4], date_str[4:6], date_str[6:]))
+
+
+def dir_index_path(config):
+    """Путь к кешу списков файлов (общий для ежедневного отчета, --follow и --rollup)"""
+
+    return os.path.join(config["STATE_DIR"], DIR_INDEX_FILE)
+
+
+def scan_dated_files(dirname, name_pat, index_path=None):
+    """Файлы каталога с датой в имени: отсортированный список (дата 'YYYYMMDD', имя).
+
+    name_pat - регулярное выражение с датой в первой группе. С index_path список хранится в кеше
+    и каталог перечитывается только при изменении его mtime (файл добавлен, удален или переименован).
+    """
+
+    dir_mtime = os.stat(dirname).st_mtime
+    key = os.path.abspath(dirname) + ':' + name_pat.pattern
+    index = load_dir_index(index_path) if index_path else {}
+    entry = index.get(key)
+    if entry and entry['mtime'] == dir_mtime:
+        return [(date_str.encode('utf-8'), name.encode('utf-8')) for date_str, name in entry['files']]
+
+    files = []
+    for name in os.listdir(dirname):
+        groups = name_pat.match(name)
+        if not groups:
+            continue
+        try:
+            datetime.datetime.strptime(groups.group(1), "%Y%m%d")
+        except ValueError:
+            logging.error("Date format is invalid: " + name)
+            continue
+        files.append((groups.group(1), name))
+    files.sort()
+
+    if index_path:
+        index[key] = {'mtime': dir_mtime, 'files': files}
+        save_dir_index(index_path, index)
+    return files
+
+
+def load_dir_index(index_path):
+    """Чтение кеша списков файлов (пустой, если его нет или он поврежден)"""
+
+    try:
+        with open(index_path, 'rb') as index_file:
+            return json.load(index_file)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_dir_index(index_path, index):
+    """Запись кеша списков файлов через временный файл + rename. Кеш лежит в отдельном подкаталоге,
+    чтобы его запись не меняла mtime индексируемых каталогов. У каждого процесса свой временный файл;
+    ошибка записи только логируется - без кеша каталог будет прочитан заново при следующем запуске"""
+
+    tmp_path = None
+    try:
+        dirname = os.path.dirname(index_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname or '.', prefix=os.path.basename(index_path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as index_file:
+            json.dump(index, index_file)
+        os.rename(tmp_path, index_path)
+    except (IOError, OSError):
+        logging.exception("Error writing directory index %s", index_path)
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 def report_exists(report_path):
@@ -107,39 +789,136 @@ def report_exists(report_path):
     return False
 
 
-def prepare_stats(lines):
-    """Подготавливаем словарь с url запроса в виде ключа и списком request_time в виде значения"""
+def prepare_stats(lines, url_rules=None, dimensions=()):
+    """Подготавливаем словарь с url запроса в виде ключа и накопителем UrlStats в виде значения.
+    На входе - кортежи полей stats_fields(dimensions): (request, request_time, поля измерений...).
+    Проход по строкам один, память на url не зависит от числа запросов.
+    url_rules (UrlRules) - нормализация url и ограничение числа ключей.
+    dimensions - имена измерений из DIMENSION_FIELDS, ключом становится кортеж (url, значения измерений...)"""
 
-    stats = defaultdict(list)
+    stats = defaultdict(UrlStats)
     requests_total = 0
     time_total = 0.0
+    normalize = make_url_normalizer(url_rules)
+    max_keys = url_rules.max_keys if url_rules else 0
+    extractors = [DIMENSION_FIELDS[name][1] for name in dimensions]
 
     for line in lines:
-        req = line['request'].split(" ")
+        req = line[0].split(" ", 2)
 
-        if req[0] != '0':
+        if req[0] != '0' and len(req) > 1:
             key = req[1]
-            time = float(line['request_time'])
-            stats[key].append(time)
+            if normalize is not None:
+                key = normalize(key)
+            if extractors:
+                key = (key,) + tuple([extract(value) for extract, value in zip(extractors, line[2:])])
+            if max_keys and key not in stats and len(stats) >= max_keys:
+                key = other_key(key)
+            time = float(line[1])
+            stats[key].add(time)
             requests_total += 1
             time_total += time
 
     return StatsData(data=stats, requests_total=requests_total, time_total=time_total)
 
 
-def make_final_list(stats, report_size):
-    """Расчет показателей для отчета"""
+def other_key(key):
+    """Ключ, в который собираются ключи сверх лимита. Лимит действует на весь ключ (url и значения измерений),
+    поэтому значения измерений тоже заменяются на OTHER_URL - иначе измерения с большим числом значений
+    (http_x_rb_user) создавали бы по ключу на каждое значение"""
 
-    report = []
-    for key in stats.data.keys():
-        count = len(stats.data[key])
+    if isinstance(key, tuple):
+        return (OTHER_URL,) * len(key)
+    return OTHER_URL
+
+
+def dimensions_from_config(config):
+    """Имена измерений из параметра DIMENSIONS (через запятую)"""
+
+    dimensions = tuple(name.strip() for name in str(config["DIMENSIONS"]).split(',') if name.strip())
+    for name in dimensions:
+        if name not in DIMENSION_FIELDS:
+            raise ValueError("Unknown dimension: %s" % name)
+    return dimensions
+
+
+def stats_fields(dimensions=()):
+    """Поля строки лога, нужные для сбора статистики с измерениями dimensions"""
+
+    return STATS_FIELDS + tuple(DIMENSION_FIELDS[name][0] for name in dimensions)
+
+
+def url_rules_from_config(config):
+    """Правила нормализации url из конфигурации (None, если нормализация и лимит выключены)"""
+
+    url_rules = UrlRules(strip_query=config_flag(config["URL_STRIP_QUERY"]),
+                         template_ids=config_flag(config["URL_TEMPLATE_IDS"]),
+                         max_keys=int(config["URL_MAX_KEYS"]))
+    if url_rules.strip_query or url_rules.template_ids or url_rules.max_keys:
+        return url_rules
+    return None
+
+
+def readers_from_config(config):
+    """Способы чтения логов из параметров PLAIN_READER и GZIP_READER"""
+
+    readers = Readers(plain=config["PLAIN_READER"], gzip=config["GZIP_READER"])
+    if readers.plain not in ('lines', 'mmap'):
+        raise ValueError("Unknown plain reader: %s" % readers.plain)
+    if readers.gzip not in ('thread', 'process', 'simple'):
+        raise ValueError("Unknown gzip reader: %s" % readers.gzip)
+    return readers
+
+
+def make_url_normalizer(url_rules):
+    """Функция нормализации url: отбрасывание query string, замена числовых сегментов пути на {id}
+    и UUID - на {uuid}. None, если нормализация не нужна"""
+
+    if not url_rules or not (url_rules.strip_query or url_rules.template_ids):
+        return None
+
+    def normalize(url):
+        path, sep, query = url.partition('?')
+        if url_rules.template_ids:
+            path = NUMERIC_SEGMENT.sub('{id}', UUID_SEGMENT.sub('{uuid}', path))
+        if url_rules.strip_query:
+            return path
+        return path + sep + query
+
+    return normalize
+
+
+def make_final_list(stats, report_size, dimensions=()):
+    """Расчет показателей для отчета.
+
+    Сначала выбираются report_size url с наибольшим time_sum (куча вместо полной сортировки),
+    медиана и проценты считаются только для них.
+    """
+
+    return list(iter_final_list(stats, report_size, dimensions))
+
+
+def iter_final_list(stats, report_size, dimensions=()):
+    """Строки отчета по одной, в порядке убывания time_sum (для потоковой записи).
+    С измерениями в строку добавляются их значения и квантили REPORT_QUANTILES. Если медиана хотя бы одной строки
+    оценена по гистограмме, во все строки добавляется граница ее погрешности time_med_err (0 - медиана точная)"""
+
+    # Отбираем url по убыванию time_sum; nlargest равносилен устойчивой сортировке с обрезкой
+    top = heapq.nlargest(report_size, stats.data.iteritems(), key=lambda item: round(item[1].time_sum, 3))
+    # Колонки отчета берутся по первой строке - time_med_err нужен во всех строках или ни в одной
+    approximate = any(url_stats.times.buckets is not None for key, url_stats in top)
+
+    for key, url_stats in top:
+        count = url_stats.count
         count_perc = round(float(100 * float(count) / float(stats.requests_total)), 3)
-        time_sum = round(sum(stats.data[key]), 3)
+        time_sum = round(url_stats.time_sum, 3)
         time_avg = round(time_sum / count, 3)
-        time_med = round(median(stats.data[key]), 3)
-        time_max = round(max(stats.data[key]), 3)
+        # Оценка по корзине может превышать максимум на погрешность скетча
+        median = min(url_stats.median(), url_stats.time_max)
+        time_med = round(median, 3)
+        time_max = round(url_stats.time_max, 3)
         time_perc = round(float(100 * float(time_sum) / float(stats.time_total)), 3)
-        report.append({
+        row = {
             'url': key,
             'count': count,
             'count_perc': count_perc,
@@ -148,32 +927,194 @@ def make_final_list(stats, report_size):
             'time_med': time_med,
             'time_max': time_max,
             'time_perc': time_perc
-        })
+        }
+        if approximate:
+            row['time_med_err'] = round(url_stats.times.error_bound(median), 3)
+        if dimensions:
+            row['url'] = key[0]
+            row.update(zip(dimensions, key[1:]))
+            for name, q in REPORT_QUANTILES:
+                row[name] = round(min(url_stats.times.quantile(q), url_stats.time_max), 3)
+        yield row
+
+
+def make_final_list_np(urls, url_ids, times, report_size):
+    """Расчет показателей для отчета по колонкам (url_id, request_time) средствами numpy.
+
+    Количество и сумма по url считаются через bincount (сложение в порядке строк, как в make_final_list),
+    затем отбираются report_size url с наибольшим time_sum. Медиана (точная) и максимум считаются только для них:
+    их строки сортируются по (url, request_time), значения берутся по границам групп.
+    Округление выполняется так же, как в make_final_list. Число строк ограничено 2**32.
+    Время ответа в колонках - float32: значения приводятся к миллисекундам (точность request_time nginx),
+    иначе медианы и суммы округляются иначе, чем при разборе текста лога.
+    """
+
+    if np is None:
+        raise RuntimeError("numpy is required for the numpy aggregator")
+
+    url_ids = np.asarray(url_ids, dtype=np.int64)
+    times = np.round(np.asarray(times).astype(np.float64), 3)
+    requests_total = len(times)
+    if not requests_total or report_size <= 0:
+        return []
+    time_total = float(times.sum())
+
+    counts = np.bincount(url_ids, minlength=len(urls))
+    sums = np.bincount(url_ids, weights=times, minlength=len(urls))
+    present = np.flatnonzero(counts)
+    top = present[top_k_order(np.round(sums[present], 3), report_size)]
+    counts, sums = counts[top], sums[top]
+
+    # Строки отобранных url, номер url в отчете - в старших 32 битах ключа сортировки, ранг времени - в младших
+    slots = np.full(len(urls), -1, dtype=np.int64)
+    slots[top] = np.arange(len(top))
+    row_slots = slots[url_ids]
+    rows = row_slots >= 0
+    row_slots, row_times = row_slots[rows], times[rows]
+
+    time_order = np.argsort(row_times)
+    time_ranks = np.empty(len(row_times), dtype=np.int64)
+    time_ranks[time_order] = np.arange(len(row_times))
+    sorted_times = row_times[time_order][np.sort((row_slots << 32) | time_ranks) & 0xFFFFFFFF]
+
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    medians = (sorted_times[starts + (counts - 1) // 2] + sorted_times[starts + counts // 2]) / 2.0
+    maxs = sorted_times[ends - 1]
+    count_percs = 100.0 * counts / requests_total
 
-    # Сортируем данные по убыванию time_sum и обрезаем лишнее
-    report.sort(key=lambda x: x['time_sum'], reverse=True)
-    report = report[:report_size]
+    report = []
+    for i, url_id in enumerate(top.tolist()):
+        count = int(counts[i])
+        time_sum = round(float(sums[i]), 3)
+        report.append({
+            'url': urls[url_id],
+            'count': count,
+            'count_perc': round(float(count_percs[i]), 3),
+            'time_sum': time_sum,
+            'time_avg': round(time_sum / count, 3),
+            'time_med': round(float(medians[i]), 3),
+            'time_max': round(float(maxs[i]), 3),
+            'time_perc': round(float(100 * float(time_sum) / time_total), 3)
+        })
 
     return report
 
 
+def top_k_order(keys, k):
+    """Индексы k наибольших keys по убыванию; при равенстве - в порядке индексов (как устойчивая сортировка).
+    Полная сортировка заменяется отбором через np.partition"""
+
+    if k < len(keys):
+        kth = np.partition(keys, len(keys) - k)[len(keys) - k]
+        candidates = np.flatnonzero(keys >= kth)
+    else:
+        candidates = np.arange(len(keys))
+    return candidates[np.argsort(-keys[candidates], kind='mergesort')][:k]
+
+
+def report_file_path(report_dir, name, report_format):
+    """Путь к отчету: report-<name>.html, .json или .json.gz"""
+
+    return os.path.join(report_dir, 'report-' + name + '.' + report_format)
+
+
+def write_report(report, report_path, report_format='html', page_size=0):
+    """Запись отчета в формате html, json или json.gz"""
+
+    if report_format == 'html':
+        return save_report(report, report_path)
+    if report_format in ('json', 'json.gz'):
+        return save_report_json(report, report_path, page_size)
+    raise ValueError("Unknown report format: %s" % report_format)
+
+
 def save_report(report, report_path):
-    """Запись отчета в файл"""
+    """Запись отчета в файл.
+    Шаблон делится по $table_json, между частями строки отчета пишутся по одной - report может быть генератором.
+    Отчет появляется только после успешной записи: при ошибке (в том числе при расчете строк) .tmp удаляется"""
 
     try:
         with open('report.html', 'r') as tmpl:
-            content = tmpl.read()
-            content = content.replace('$table_json', json.dumps(report))
+            prefix, suffix = tmpl.read().split('$table_json', 1)
         with open(report_path + '.tmp', 'w') as rp_file:
-            rp_file.write(content)
+            rp_file.write(prefix)
+            write_json_rows(rp_file, report)
+            rp_file.write(suffix)
     except:
         logging.exception("Error writing report file")
+        if os.path.exists(report_path + '.tmp'):
+            os.unlink(report_path + '.tmp')
+        raise
 
     os.rename(report_path + '.tmp', report_path)
     logging.info("Report complete")
     return report_path
 
 
+def save_report_json(report, report_path, page_size=0):
+    """Запись отчета в json (.json.gz - со сжатием).
+
+    При page_size > 0 строки пишутся страницами report-<name>-0001.json, report-<name>-0002.json, ...,
+    а report_path содержит оглавление: число строк, размер страницы и имена файлов страниц.
+    Оглавление пишется последним; при ошибке .tmp и записанные страницы удаляются, отчет не появляется.
+    """
+
+    opener = gzip.open if report_path.endswith('.gz') else open
+    created = [report_path + '.tmp']
+    try:
+        if page_size <= 0:
+            with opener(report_path + '.tmp', 'wb') as rp_file:
+                write_json_rows(rp_file, report)
+            os.rename(report_path + '.tmp', report_path)
+            logging.info("Report complete")
+            return report_path
+
+        ext = '.json.gz' if report_path.endswith('.json.gz') else '.json'
+        base = report_path[:-len(ext)]
+        rows_iter = iter(report)
+        pages = []
+        rows_total = 0
+        while True:
+            rows = list(itertools.islice(rows_iter, page_size))
+            if not rows and pages:
+                break
+            page_path = '%s-%04d%s' % (base, len(pages) + 1, ext)
+            created.extend([page_path + '.tmp', page_path])
+            with opener(page_path + '.tmp', 'wb') as page_file:
+                write_json_rows(page_file, rows)
+            os.rename(page_path + '.tmp', page_path)
+            pages.append(os.path.basename(page_path))
+            rows_total += len(rows)
+            if len(rows) < page_size:
+                break
+
+        with opener(report_path + '.tmp', 'wb') as rp_file:
+            json.dump({'rows': rows_total, 'page_size': page_size, 'pages': pages}, rp_file)
+        os.rename(report_path + '.tmp', report_path)
+    except:
+        logging.exception("Error writing report file")
+        for path in created:
+            if os.path.exists(path):
+                os.unlink(path)
+        raise
+
+    logging.info("Report complete: %s rows in %s pages" % (rows_total, len(pages)))
+    return report_path
+
+
+def write_json_rows(out, rows):
+    """Потоковая запись строк отчета json-массивом (тот же текст, что и json.dumps(list(rows)))"""
+
+    out.write('[')
+    separator = ''
+    for row in rows:
+        out.write(separator)
+        out.write(json.dumps(row))
+        separator = ', '
+    out.write(']')
+
+
 def median(lst):
     """Расчет медианы """
 
@@ -186,28 +1127,625 @@ def median(lst):
         return sum(sorted(lst)[n//2-1:n//2+1])/2.0
 
 
-def read_lines(log_path, parsing_ratio):
-    """Чтение строк из файла """
+def read_lines(log_path, parsing_ratio, fields=STATS_FIELDS, readers=None):
+    """Чтение строк из файла, для каждой строки - кортеж значений полей fields.
+    readers (Readers) - способы чтения plain и .gz логов, по умолчанию DEFAULT_READERS"""
 
-    if log_path.endswith(".gz"):
-        log = gzip.open(log_path,'rb')
+    readers = readers or DEFAULT_READERS
+    counters = {'total': 0, 'processed': 0}
+    if fields == STATS_FIELDS and not log_path.endswith(".gz") and readers.plain == 'mmap':
+        for parsed_line in mmap_lines(log_path, counters):
+            yield parsed_line
     else:
-        log = open(log_path)
+        log = open_log(log_path, readers.gzip)
+        try:
+            for parsed_line in parse_lines(log, counters, fields):
+                yield parsed_line
+        finally:
+            log.close()
+
+    check_parsing_ratio(counters['processed'], counters['total'], parsing_ratio)
+
+
+def open_log(log_path, gzip_reader=None):
+    """Открытие plain или .gz лога.
+
+    gzip_reader (по умолчанию DEFAULT_READERS.gzip) - способ чтения .gz: thread - распаковка в отдельном потоке,
+    process - внешним pigz/gzip, simple - gzip.open. В режимах thread и process распаковка идет параллельно
+    с разбором строк, строки выделяются из больших распакованных блоков.
+    """
+
+    if log_path.endswith(".gz"):
+        gzip_reader = gzip_reader or DEFAULT_READERS.gzip
+        if gzip_reader == 'simple':
+            return gzip.open(log_path, 'rb')
+        if gzip_reader in ('thread', 'process'):
+            return GzipLines(log_path, gzip_reader)
+        raise ValueError("Unknown gzip reader: %s" % gzip_reader)
+    return open(log_path)
+
+
+class GzipLines(object):
+    """Строки gzip-файла, распаковка которого идет параллельно с их обработкой.
+
+    В режиме thread блоки файла распаковываются zlib (или isal, если установлен) в отдельном потоке -
+    zlib отпускает GIL на время распаковки. В режиме process файл распаковывает внешний pigz или gzip -dc.
+    Распакованные блоки делятся на строки одним split.
+    """
+
+    def __init__(self, log_path, mode='thread'):
+        self.log_path = log_path
+        self.mode = mode
+        self.process = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.blocks = Queue.Queue(GZIP_QUEUE_BLOCKS)
+
+        if mode == 'process':
+            self.process = subprocess.Popen([gzip_command(), '-dc', log_path], stdout=subprocess.PIPE,
+                                            bufsize=GZIP_BLOCK_SIZE)
+        else:
+            self.thread = threading.Thread(target=self._decompress)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def __iter__(self):
+        tail = ''
+        for block in self._iter_blocks():
+            lines = (tail + block).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if tail:
+            yield tail
+
+    def close(self):
+        self.stopped.set()
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.stdout.close()
+            self.process.wait()
+        if self.thread is not None:
+            # Освобождаем место в очереди, чтобы поток увидел остановку
+            while self.thread.is_alive():
+                try:
+                    self.blocks.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+
+    def _iter_blocks(self):
+        if self.process is not None:
+            while True:
+                block = self.process.stdout.read(GZIP_BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+            if self.process.wait() != 0:
+                raise IOError("Error decompressing %s" % self.log_path)
+            return
+
+        while True:
+            block = self.blocks.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    def _decompress(self):
+        """Поток распаковки: блоки распакованных данных в очередь, в конце - None (или исключение)"""
+
+        try:
+            with open(self.log_path, 'rb') as raw:
+                decompressor = gzip_zlib.decompressobj(16 + zlib.MAX_WBITS)
+                started = False
+                while not self.stopped.is_set():
+                    data = raw.read(GZIP_BLOCK_SIZE)
+                    if not data:
+                        break
+                    started = True
+                    while data:
+                        block = decompressor.decompress(data)
+                        if block:
+                            self._put(block)
+                        # Конец gzip-члена: остаток относится к следующему члену файла
+                        data = decompressor.unused_data
+                        if data.strip('\0'):
+                            decompressor = gzip_zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        else:
+                            data = ''
+                if self.stopped.is_set():
+                    return
+                # Обрезанный или поврежденный файл - ошибка, как у gzip.open, а не часть строк
+                if started and not _stream_ended(decompressor):
+                    raise IOError("Compressed file ended before the end-of-stream marker")
+                self._put(decompressor.flush())
+            self._put(None)
+        except Exception as err:
+            self._put(err)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+
+def _stream_ended(decompressor):
+    """Дошел ли распаковщик до конца gzip-члена. В zlib Python 2 нет атрибута eof: после конца потока
+    новые данные попадают в unused_data - это проверяется на копии распаковщика"""
 
-    total = processed = 0
-    for line in log:
-        parsed_line = process_line(line)
-        total += 1
+    eof = getattr(decompressor, 'eof', None)
+    if eof is not None:
+        return eof
+    probe = decompressor.copy()
+    try:
+        probe.decompress('\0')
+    except zlib.error:
+        return False
+    return probe.unused_data == '\0'
+
+
+def gzip_command():
+    """Внешний распаковщик: pigz, если установлен, иначе gzip"""
+
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(path, 'pigz'), os.X_OK):
+            return 'pigz'
+    return 'gzip'
+
+
+def mmap_lines(log_path, counters, start=0, end=None):
+    """(request, request_time) строк plain-файла из диапазона байт [start, end) через mmap.
+
+    MMAP_LINE применяется прямо к отображенному файлу. Строки, не разобранные выражением или с другим числом
+    кавычек, проверяются project_line, так что принимается ровно то, что принимает построчное чтение.
+    """
+
+    with open(log_path, 'rb') as log:
+        if end is None:
+            end = os.fstat(log.fileno()).st_size
+        if end <= start:
+            return
+        mm = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start
+            for match in MMAP_LINE.finditer(mm, start, end):
+                counters['total'] += 1
+                if match.lastindex and match.group().count('"') == 12:
+                    counters['processed'] += 1
+                    yield match.group(1, 2)
+                else:
+                    parsed_line = project_line(match.group())
+                    if parsed_line:
+                        counters['processed'] += 1
+                        yield parsed_line
+                pos = match.end()
+
+            # Последняя строка без перевода строки
+            if pos < end:
+                counters['total'] += 1
+                parsed_line = project_line(mm[pos:end])
+                if parsed_line:
+                    counters['processed'] += 1
+                    yield parsed_line
+        finally:
+            mm.close()
+
+
+def parse_lines(raw_lines, counters, fields=STATS_FIELDS):
+    """Парсинг строк с подсчетом всех и успешно обработанных строк в counters"""
+
+    for line in raw_lines:
+        parsed_line = project_line(line, fields)
+        counters['total'] += 1
         if parsed_line:
-            processed += 1
+            counters['processed'] += 1
             yield parsed_line
 
-    # Проверка: если доля обработанных строк меньше parsing_ratio - ошибка формата данных
-    if processed / total < parsing_ratio:
+
+def check_parsing_ratio(processed, total, parsing_ratio):
+    """Проверка: если доля обработанных строк меньше parsing_ratio - ошибка формата данных"""
+
+    if not total or float(processed) / total < parsing_ratio:
         raise RuntimeError("Too much parsing errors, check log file format")
 
     logging.info("%s of %s lines processed" % (processed, total))
-    log.close()
+
+
+def prepare_stats_parallel(log_path, parsing_ratio, workers, readers=None):
+    """Сбор статистики в нескольких процессах, доля обработанных строк проверяется по всему файлу"""
+
+    stats, total, processed = collect_stats(log_path, workers, readers=readers)
+    check_parsing_ratio(processed, total, parsing_ratio)
+    return stats
+
+
+def prepare_stats_incremental(log_path, state_path, parsing_ratio, workers=1, url_rules=None, dimensions=(),
+                              readers=None):
+    """Сбор статистики с продолжением с сохраненного смещения.
+
+    Сводные данные по url, смещение и счетчики строк хранятся в state_path. Если файл тот же (inode совпадает,
+    он не стал короче, измерения, правила url и погрешность квантилей не менялись), читаются только байты после смещения
+    до конца последней полной строки.
+    Gzip-лог не дописывается, поэтому он разбирается один раз, дальше используется сохраненное состояние.
+    """
+
+    log_stat = os.stat(log_path)
+    state = load_state(state_path)
+    if state and state['inode'] == log_stat.st_ino and state['offset'] <= log_stat.st_size \
+            and state_compatible(state, dimensions, url_rules):
+        stats, offset, total, processed = state['stats'], state['offset'], state['total'], state['processed']
+    else:
+        stats = StatsData(data=defaultdict(UrlStats), requests_total=0, time_total=0.0)
+        offset = total = processed = 0
+
+    if log_path.endswith(".gz"):
+        end = log_stat.st_size
+        if offset != end:
+            stats, total, processed = collect_stats(log_path, workers, url_rules=url_rules, dimensions=dimensions,
+                                                    readers=readers)
+    else:
+        end = last_line_end(log_path, offset, log_stat.st_size)
+        if end > offset:
+            part, part_total, part_processed = collect_stats(log_path, workers, offset, end, url_rules, dimensions,
+                                                             readers)
+            stats = merge_stats(stats, part, url_rules.max_keys if url_rules else 0)
+            total += part_total
+            processed += part_processed
+
+    logging.info("Incremental update: %s new bytes" % (end - offset))
+    check_parsing_ratio(processed, total, parsing_ratio)
+    save_state(state_path, stats, inode=log_stat.st_ino, offset=end, total=total, processed=processed,
+               dimensions=list(dimensions), url_rules=_url_rules_state(url_rules), quantile_mode=QUANTILE_MODE,
+               quantile_accuracy=SKETCH_ACCURACY)
+    return stats
+
+
+def collect_stats(log_path, workers=1, start=0, end=None, url_rules=None, dimensions=(), readers=None):
+    """Сбор статистики (stats, total, processed) по всему файлу или диапазону байт plain-файла.
+
+    При workers > 1 plain-лог делится на куски по байтам (границы выравниваются по концу строки), каждый кусок
+    читает и агрегирует свой процесс. Gzip-поток последовательно распаковывается в основном процессе
+    и раздается обработчикам пачками по WORKER_BATCH_LINES строк. Частичные результаты сливаются,
+    лимит числа url (url_rules.max_keys) применяется и при слиянии. Измерения dimensions считаются в том же проходе.
+    readers (Readers) - способы чтения логов, передаются и в процессы-обработчики.
+    """
+
+    readers = readers or DEFAULT_READERS
+    if end is None and not log_path.endswith(".gz"):
+        end = os.path.getsize(log_path)
+
+    if workers <= 1:
+        if log_path.endswith(".gz"):
+            log = open_log(log_path, readers.gzip)
+            try:
+                part, total, processed = _stats_batch(log, url_rules, dimensions)
+            finally:
+                log.close()
+        else:
+            part, total, processed = _stats_chunk((log_path, start, end, url_rules, dimensions, readers.plain))
+        return StatsData(*part), total, processed
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        if log_path.endswith(".gz"):
+            parts = pool.imap_unordered(functools.partial(_stats_batch, url_rules=url_rules, dimensions=dimensions),
+                                        _read_batches(log_path, WORKER_BATCH_LINES, readers.gzip))
+        else:
+            chunks = [(log_path, chunk_start, chunk_end, url_rules, dimensions, readers.plain)
+                      for chunk_start, chunk_end in split_log(log_path, workers * 2, start, end)]
+            parts = pool.imap_unordered(_stats_chunk, chunks)
+
+        stats = StatsData(data=defaultdict(UrlStats), requests_total=0, time_total=0.0)
+        total = processed = 0
+        for part, part_total, part_processed in parts:
+            stats = merge_stats(stats, StatsData(*part), url_rules.max_keys if url_rules else 0)
+            total += part_total
+            processed += part_processed
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    return stats, total, processed
+
+
+def split_log(log_path, parts, start=0, end=None):
+    """Границы кусков plain-файла (start, end), выровненные по началу строк"""
+
+    if end is None:
+        end = os.path.getsize(log_path)
+    bounds = [start]
+    with open(log_path, 'rb') as log:
+        for i in range(1, parts):
+            log.seek(start + (end - start) * i // parts)
+            log.readline()
+            pos = log.tell()
+            if bounds[-1] < pos < end:
+                bounds.append(pos)
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def last_line_end(log_path, start, size, block_size=1 << 16):
+    """Смещение конца последней полной строки в [start, size) - недописанная строка остается на следующий запуск"""
+
+    with open(log_path, 'rb') as log:
+        pos = size
+        while pos > start:
+            block_start = max(start, pos - block_size)
+            log.seek(block_start)
+            block = log.read(pos - block_start)
+            idx = block.rfind('\n')
+            if idx >= 0:
+                return block_start + idx + 1
+            pos = block_start
+    return start
+
+
+def save_state(state_path, stats, **meta):
+    """Запись сводных данных и метаданных (смещение, счетчики) в gzip json, через .tmp + rename"""
+
+    dirname = os.path.dirname(state_path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+
+    state = dict(meta)
+    state['requests_total'] = stats.requests_total
+    state['time_total'] = stats.time_total
+    state['urls'] = [[key, url_stats.count, url_stats.time_sum, url_stats.time_max, url_stats.times.values,
+                      sorted(url_stats.times.buckets.iteritems()) if url_stats.times.buckets is not None else None,
+                      url_stats.times.zeros]
+                     for key, url_stats in stats.data.iteritems()]
+
+    # json.dump пишет в gzip по одному токену, одна запись готовой строки в разы быстрее
+    with gzip.open(state_path + '.tmp', 'wb') as state_file:
+        state_file.write(json.dumps(state))
+    os.rename(state_path + '.tmp', state_path)
+    return state_path
+
+
+def state_compatible(state, dimensions=(), url_rules=None):
+    """Можно ли продолжать и объединять сводные данные state: тот же набор измерений, те же правила url
+    (иначе в одних данных смешаются исходные и нормализованные ключи), тот же режим оценки квантилей
+    (иначе в режиме exact продолжатся гистограммы) и та же погрешность гистограмм (от нее зависят номера корзин).
+    State без правил url собран без нормализации и лимита"""
+
+    return state.get('dimensions', []) == list(dimensions) \
+        and state.get('url_rules', _url_rules_state(None)) == _url_rules_state(url_rules) \
+        and state.get('quantile_mode', STATE_DEFAULT_MODE) == QUANTILE_MODE \
+        and state.get('quantile_accuracy', STATE_DEFAULT_ACCURACY) == SKETCH_ACCURACY
+
+
+def _url_rules_state(url_rules):
+    """Правила url для state-файла: [strip_query, template_ids, max_keys]; None - без нормализации и лимита"""
+
+    return list(url_rules or UrlRules(strip_query=False, template_ids=False, max_keys=0))
+
+
+def load_state(state_path):
+    """Чтение state-файла: метаданные и сводные данные в state['stats'] (None, если файла нет)"""
+
+    if not os.path.exists(state_path):
+        return None
+
+    with gzip.open(state_path, 'rb') as state_file:
+        state = json.load(state_file)
+
+    data = defaultdict(UrlStats)
+    for key, count, time_sum, time_max, values, buckets, zeros in state.pop('urls'):
+        if isinstance(key, list):
+            key = tuple(key)
+        url_stats = data[key]
+        url_stats.count, url_stats.time_sum, url_stats.time_max = count, time_sum, time_max
+        sketch = url_stats.times
+        sketch.count, sketch.values, sketch.zeros = count, values, zeros
+        if buckets is not None:
+            sketch.buckets = dict((idx, cnt) for idx, cnt in buckets)
+
+    state['stats'] = StatsData(data=data, requests_total=state.pop('requests_total'),
+                               time_total=state.pop('time_total'))
+    return state
+
+
+def read_range(log_path, start, end, block_size=1 << 20):
+    """Строки plain-файла из диапазона байт [start, end), чтение блоками"""
+
+    with open(log_path, 'rb') as log:
+        log.seek(start)
+        left = end - start
+        tail = ''
+        while left > 0:
+            block = log.read(min(block_size, left))
+            if not block:
+                break
+            left -= len(block)
+            lines = (tail + block).split('\n')
+            tail = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if tail:
+            yield tail
+
+
+class LogFollower(object):
+    """Чтение дописываемого plain-лога: read_lines возвращает полные строки, появившиеся с прошлого вызова.
+
+    Если файл по пути log_path заменен (logrotate переименовал его и создал новый - другой inode),
+    старый файл дочитывается до конца и открывается новый с начала; усеченный файл (copytruncate)
+    читается с начала. Недописанная строка ждет следующего вызова.
+    """
+
+    def __init__(self, log_path, from_start=False):
+        self.log_path = log_path
+        self.log = io.open(log_path, 'rb')
+        if not from_start:
+            self.log.seek(0, os.SEEK_END)
+        self.tail = ''
+
+    def read_lines(self):
+        lines = self._read_available()
+        try:
+            path_stat = os.stat(self.log_path)
+        except OSError:
+            # Файл переименован, новый еще не создан - продолжаем читать старый
+            return lines
+
+        if path_stat.st_ino != os.fstat(self.log.fileno()).st_ino:
+            lines.extend(self.switch(self.log_path))
+        elif path_stat.st_size < self.log.tell():
+            self.log.seek(0)
+            self.tail = ''
+            lines.extend(self._read_available())
+        return lines
+
+    def switch(self, log_path):
+        """Переход на другой файл: остаток текущего (включая строку без перевода строки) и строки нового"""
+
+        lines = self._read_available()
+        if self.tail:
+            lines.append(self.tail)
+            self.tail = ''
+        self.log.close()
+        self.log_path = log_path
+        self.log = io.open(log_path, 'rb')
+        lines.extend(self._read_available())
+        return lines
+
+    def close(self):
+        self.log.close()
+
+    def _read_available(self):
+        lines = []
+        while True:
+            block = self.log.read(GZIP_BLOCK_SIZE)
+            if not block:
+                return lines
+            block_lines = (self.tail + block).split('\n')
+            self.tail = block_lines.pop()
+            lines.extend(line + '\n' for line in block_lines)
+
+
+class RollingStats(object):
+    """Статистика для скользящих окон: отдельная StatsData на каждую минуту времени лога.
+
+    Корзины старше keep_minutes от последней минуты лога удаляются, окно собирается слиянием корзин,
+    так что память ограничена числом минут и ключей, а не числом строк.
+    """
+
+    def __init__(self, keep_minutes, url_rules=None, dimensions=()):
+        self.keep_minutes = keep_minutes
+        self.url_rules = url_rules
+        self.dimensions = dimensions
+        self.buckets = {}
+        self.latest = None
+        self._minutes = {}
+
+    def add(self, lines):
+        """Строки - кортежи полей stats_fields(dimensions) + ('time_local',)"""
+
+        groups = defaultdict(list)
+        for line in lines:
+            groups[self._minute(line[-1])].append(line)
+
+        max_keys = self.url_rules.max_keys if self.url_rules else 0
+        for minute, group in groups.iteritems():
+            part = prepare_stats(group, self.url_rules, self.dimensions)
+            if minute in self.buckets:
+                part = merge_stats(self.buckets[minute], part, max_keys)
+            self.buckets[minute] = part
+            if self.latest is None or minute > self.latest:
+                self.latest = minute
+
+        if groups:
+            oldest = self.latest - datetime.timedelta(minutes=self.keep_minutes)
+            for minute in [minute for minute in self.buckets if minute <= oldest]:
+                del self.buckets[minute]
+            if len(self._minutes) > self.keep_minutes * 4:
+                self._minutes.clear()
+
+    def window(self, minutes):
+        """Статистика за последние minutes минут лога (новые накопители, корзины не меняются)"""
+
+        data = defaultdict(UrlStats)
+        requests_total = 0
+        time_total = 0.0
+        if self.latest is not None:
+            oldest = self.latest - datetime.timedelta(minutes=minutes)
+            for minute, bucket in self.buckets.iteritems():
+                if minute > oldest:
+                    for key, url_stats in bucket.data.iteritems():
+                        data[key].merge(url_stats)
+                    requests_total += bucket.requests_total
+                    time_total += bucket.time_total
+        return StatsData(data=data, requests_total=requests_total, time_total=time_total)
+
+    def _minute(self, time_local):
+        """Минута из time_local ('29/Jun/2017:03:50:22 +0300'), разобранные значения кешируются"""
+
+        prefix = time_local[:17]
+        minute = self._minutes.get(prefix)
+        if minute is None:
+            minute = self._minutes[prefix] = datetime.datetime.strptime(prefix, "%d/%b/%Y:%H:%M")
+        return minute
+
+
+def merge_stats(stats, other, max_keys=0):
+    """Слияние частичной статистики other в stats; новые ключи сверх max_keys сливаются в other_key"""
+
+    for key, url_stats in other.data.iteritems():
+        if max_keys and key not in stats.data and len(stats.data) >= max_keys:
+            key = other_key(key)
+        if key in stats.data:
+            stats.data[key].merge(url_stats)
+        else:
+            stats.data[key] = url_stats
+    return StatsData(data=stats.data, requests_total=stats.requests_total + other.requests_total,
+                     time_total=stats.time_total + other.time_total)
+
+
+def _read_batches(log_path, batch_lines, gzip_reader=None):
+    """Пачки строк gzip-лога для передачи в процессы-обработчики"""
+
+    log = open_log(log_path, gzip_reader)
+    try:
+        batch = []
+        for line in log:
+            batch.append(line)
+            if len(batch) >= batch_lines:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        log.close()
+
+
+def _stats_batch(lines, url_rules=None, dimensions=()):
+    """Обработчик пачки строк (выполняется в дочернем процессе).
+    StatsData возвращается обычным кортежем - namedtuple с другим именем типа не сериализуется"""
+
+    counters = {'total': 0, 'processed': 0}
+    stats = prepare_stats(parse_lines(lines, counters, stats_fields(dimensions)), url_rules, dimensions)
+    return tuple(stats), counters['total'], counters['processed']
+
+
+def _stats_chunk(chunk):
+    """Обработчик куска plain-файла (log_path, start, end, url_rules, dimensions, plain_reader),
+    выполняется в дочернем процессе"""
+
+    log_path, start, end, url_rules, dimensions, plain_reader = chunk
+    if plain_reader == 'mmap' and not dimensions:
+        counters = {'total': 0, 'processed': 0}
+        stats = prepare_stats(mmap_lines(log_path, counters, start, end), url_rules)
+        return tuple(stats), counters['total'], counters['processed']
+    return _stats_batch(read_range(log_path, start, end), url_rules, dimensions)
 
 
 def process_line(line):
@@ -217,16 +1755,277 @@ def process_line(line):
         groups = logpat.match(line)
         tuples = groups.groups()
 
-        colnames = ('remote_addr', 'remote_user', 'http_x_real_ip', 'time_local', 'request', 'status', 'body_bytes_sent', 'http_referer', 'http_user_agent',
-                    'http_x_forwarded_for', 'http_x_request_id', 'http_x_rb_user', 'request_time')
-
-        log = dict(zip(colnames, tuples))
+        log = dict(zip(COLNAMES, tuples))
         return log
 
     except:
         return False
 
 
+def project_line(line, fields=STATS_FIELDS, validate=False):
+    """Извлечение из строки только полей fields (кортеж значений или None).
+
+    Быстрый путь разбирает строку по кавычкам без регулярного выражения и без словаря;
+    полный logpat применяется, если нужна проверка (validate) или строка не прошла быструю проверку формата.
+    """
+
+    if not validate:
+        if fields == STATS_FIELDS:
+            values = _fast_request_fields(line)
+        else:
+            values = _fast_fields(line, fields)
+        if values is not None:
+            return values
+
+    groups = logpat.match(line)
+    if groups is None:
+        return None
+    if len(fields) == 1:
+        return (groups.group(COLGROUPS[fields[0]]),)
+    return groups.group(*[COLGROUPS[field] for field in fields])
+
+
+def _fast_request_fields(line):
+    """Быстрое извлечение (request, request_time)"""
+
+    if line.count('"') != 12:
+        return None
+    start = line.find('"') + 1
+    end = line.find('"', start)
+    if not line.startswith(' ', end + 1):
+        return None
+    request_time = line[line.rfind(' ') + 1:].rstrip()
+    if not request_time.replace('.', '', 1).isdigit():
+        return None
+    return line[start:end], request_time
+
+
+def _fast_fields(line, fields):
+    """Быстрое извлечение произвольных полей через разбиение по кавычкам"""
+
+    parts = line.split('"')
+    if len(parts) != 13 or parts[4] != ' ' or parts[6] != ' ' or parts[8] != ' ' or parts[10] != ' ':
+        return None
+    request_time = parts[12].strip()
+    if not request_time.replace('.', '', 1).isdigit():
+        return None
+    return tuple([_FAST_FIELDS[field](parts) for field in fields])
+
+
+def _time_local(head):
+    start = head.find('[') + 1
+    return head[start:head.find(']', start)]
+
+
+# Извлечение полей из частей строки, разбитой по кавычкам
+_FAST_FIELDS = {
+    'remote_addr': lambda parts: parts[0].split(' ', 1)[0],
+    'remote_user': lambda parts: parts[0].split(' ', 2)[1],
+    'http_x_real_ip': lambda parts: parts[0].split()[2],
+    'time_local': lambda parts: _time_local(parts[0]),
+    'request': lambda parts: parts[1],
+    'status': lambda parts: parts[2].split()[0],
+    'body_bytes_sent': lambda parts: parts[2].split()[1],
+    'http_referer': lambda parts: parts[3],
+    'http_user_agent': lambda parts: parts[5],
+    'http_x_forwarded_for': lambda parts: parts[7],
+    'http_x_request_id': lambda parts: parts[9],
+    'http_x_rb_user': lambda parts: parts[11],
+    'request_time': lambda parts: parts[12].strip(),
+}
+
+
+def convert_log(log_path, col_path, parsing_ratio, url_rules=None, readers=None):
+    """Запись разобранного лога в колоночный формат.
+
+    col_path - каталог с файлами: urls.txt (словарь url, номер строки - id), url_id.bin (uint32),
+    request_time.bin (float32), status.bin (uint16), все little-endian, и meta.json с числом строк,
+    счетчиками строк лога, его inode и размером (для state-файла дня).
+    url нормализуются по url_rules, как при сборе статистики, лог читается способом readers.gzip (Readers).
+    Каталог пишется в .tmp и переименовывается после проверки доли разобранных строк.
+    """
+
+    tmp_path = col_path + '.tmp'
+    if not os.path.exists(tmp_path):
+        os.makedirs(tmp_path)
+
+    url_ids = {}
+    normalize = make_url_normalizer(url_rules)
+    max_keys = url_rules.max_keys if url_rules else 0
+    counters = {'total': 0, 'processed': 0}
+    buffers = dict((name, array.array(code)) for name, code, _ in COLUMNS)
+    files = dict((name, open(os.path.join(tmp_path, name + '.bin'), 'wb')) for name, _, _ in COLUMNS)
+    rows = 0
+    log = open_log(log_path, (readers or DEFAULT_READERS).gzip)
+    try:
+        for request, request_time, status in parse_lines(log, counters, COLUMNAR_FIELDS):
+            req = request.split(" ", 2)
+            if req[0] == '0' or len(req) < 2:
+                continue
+
+            url = req[1] if normalize is None else normalize(req[1])
+            url_id = url_ids.get(url)
+            if url_id is None:
+                if max_keys and len(url_ids) >= max_keys:
+                    url = OTHER_URL
+                url_id = url_ids.get(url)
+                if url_id is None:
+                    url_id = url_ids[url] = len(url_ids)
+            buffers['url_id'].append(url_id)
+            buffers['request_time'].append(float(request_time))
+            buffers['status'].append(int(status))
+            rows += 1
+
+            if len(buffers['url_id']) >= COLUMNAR_BLOCK_ROWS:
+                _flush_columns(buffers, files)
+        _flush_columns(buffers, files)
+    finally:
+        log.close()
+        for column_file in files.itervalues():
+            column_file.close()
+
+    check_parsing_ratio(counters['processed'], counters['total'], parsing_ratio)
+    log_stat = os.stat(log_path)
+
+    urls = [None] * len(url_ids)
+    for url, url_id in url_ids.iteritems():
+        urls[url_id] = url
+    with open(os.path.join(tmp_path, 'urls.txt'), 'w') as urls_file:
+        for url in urls:
+            urls_file.write(url + '\n')
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as meta_file:
+        json.dump({'source': os.path.basename(log_path), 'rows': rows, 'urls': len(urls),
+                   'total': counters['total'], 'processed': counters['processed'],
+                   'inode': log_stat.st_ino, 'size': log_stat.st_size}, meta_file)
+
+    os.rename(tmp_path, col_path)
+    logging.info("Columnar file complete: %s rows, %s urls" % (rows, len(urls)))
+    return col_path
+
+
+def _flush_columns(buffers, files):
+    """Дозапись накопленных значений колонок в файлы"""
+
+    for name, code, _ in COLUMNS:
+        buf = buffers[name]
+        if sys.byteorder == 'big':
+            buf.byteswap()
+        buf.tofile(files[name])
+        buffers[name] = array.array(code)
+
+
+def load_columns(col_path):
+    """Чтение колоночного файла: {'urls': [...], 'rows': n, 'meta': meta.json, <колонка>: массив}.
+
+    При наличии numpy колонки отображаются в память (numpy.memmap), иначе читаются в array.array.
+    """
+
+    with open(os.path.join(col_path, 'meta.json')) as meta_file:
+        meta = json.load(meta_file)
+    with open(os.path.join(col_path, 'urls.txt')) as urls_file:
+        urls = urls_file.read().split('\n')[:meta['urls']]
+
+    rows = meta['rows']
+    columns = {'urls': urls, 'rows': rows, 'meta': meta}
+    for name, code, dtype in COLUMNS:
+        path = os.path.join(col_path, name + '.bin')
+        if np is not None:
+            columns[name] = np.memmap(path, dtype=dtype, mode='r', shape=(rows,)) if rows else np.zeros(0, dtype)
+        else:
+            columns[name] = array.array(code)
+            with open(path, 'rb') as column_file:
+                columns[name].fromfile(column_file, rows)
+            if sys.byteorder == 'big':
+                columns[name].byteswap()
+
+    return columns
+
+
+def stats_from_columns(columns):
+    """Сводные данные по url из колоночного файла (время float32 приводится к миллисекундам)"""
+
+    urls = columns['urls']
+    url_ids = columns['url_id']
+    times = columns['request_time']
+    if np is not None:
+        return _stats_from_columns_np(urls, url_ids, times)
+
+    stats = defaultdict(UrlStats)
+    time_total = 0.0
+    for url_id, time in zip(url_ids, times):
+        time = round(time, 3)
+        stats[urls[url_id]].add(time)
+        time_total += time
+
+    return StatsData(data=stats, requests_total=len(url_ids), time_total=time_total)
+
+
+def save_columns_state(columns, log_path, state_path, url_rules=None):
+    """State-файл дня по колоночному файлу: те же сводные данные и метаданные, что у prepare_stats_incremental.
+    Колоночные файлы, записанные до появления inode и размера в meta.json, берут их у текущего лога.
+    Возвращает число запросов"""
+
+    meta = columns['meta']
+    log_stat = os.stat(log_path)
+    stats = stats_from_columns(columns)
+    save_state(state_path, stats, inode=meta.get('inode', log_stat.st_ino), offset=meta.get('size', log_stat.st_size),
+               total=meta['total'], processed=meta['processed'], dimensions=[],
+               url_rules=_url_rules_state(url_rules), quantile_mode=QUANTILE_MODE, quantile_accuracy=SKETCH_ACCURACY)
+    return stats.requests_total
+
+
+def _stats_from_columns_np(urls, url_ids, times):
+    """stats_from_columns средствами numpy: построчный цикл только по url и корзинам гистограмм.
+    Суммы складываются в порядке строк, как при потоковом сборе"""
+
+    url_ids = np.asarray(url_ids, dtype=np.int64)
+    times = np.round(np.asarray(times).astype(np.float64), 3)
+    counts = np.bincount(url_ids, minlength=len(urls))
+    sums = np.bincount(url_ids, weights=times, minlength=len(urls))
+    order = np.lexsort((times, url_ids))
+    sorted_times = times[order]
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    # Корзины гистограммы для url, у которых значений больше SKETCH_EXACT_LIMIT
+    large = counts > SKETCH_EXACT_LIMIT
+    buckets = defaultdict(dict)
+    zeros = defaultdict(int)
+    rows = large[url_ids]
+    if rows.any():
+        big_ids, big_times = url_ids[rows], times[rows]
+        positive = big_times > 0
+        for url_id, cnt in zip(*np.unique(big_ids[~positive], return_counts=True)):
+            zeros[int(url_id)] = int(cnt)
+        idx = np.ceil(np.log(big_times[positive]) / SKETCH_LOG_GAMMA).astype(np.int64)
+        keys, cnts = np.unique((big_ids[positive] << 32) + (idx + (1 << 31)), return_counts=True)
+        for key, cnt in zip(keys.tolist(), cnts.tolist()):
+            buckets[key >> 32][(key & 0xFFFFFFFF) - (1 << 31)] = cnt
+
+    stats = defaultdict(UrlStats)
+    for url_id in np.flatnonzero(counts).tolist():
+        url_stats = stats[urls[url_id]]
+        url_stats.count = int(counts[url_id])
+        url_stats.time_sum = float(sums[url_id])
+        url_stats.time_max = float(sorted_times[ends[url_id] - 1])
+        sketch = url_stats.times
+        sketch.count = url_stats.count
+        if large[url_id]:
+            sketch.buckets = buckets[url_id]
+            sketch.zeros = zeros[url_id]
+        else:
+            sketch.values = sorted_times[starts[url_id]:ends[url_id]].tolist()
+
+    time_total = float(np.cumsum(times)[-1]) if len(times) else 0.0
+    return StatsData(data=stats, requests_total=len(times), time_total=time_total)
+
+
+def config_flag(value):
+    """Булево значение параметра конфигурации ('1', 'true', 'yes', 'on' или True)"""
+
+    return value is True or str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 def init_log(filename):
     """Инициализация лога """
 
@@ -244,7 +2043,12 @@ def parse_config_file(config_file, config):
         conf = ConfigParser.ConfigParser()
         conf.read(config_file)
 
-        props = ("REPORT_SIZE", "LOG_DIR", "REPORT_DIR", "FILE_PATTERN", "SCRIPT_LOG", "PARSING_RATIO")
+        props = ("REPORT_SIZE", "LOG_DIR", "REPORT_DIR", "FILE_PATTERN", "SCRIPT_LOG", "PARSING_RATIO", "WORKERS",
+                 "INCREMENTAL", "STATE_DIR", "COLUMNAR_DIR", "AGGREGATOR",
+                 "URL_STRIP_QUERY", "URL_TEMPLATE_IDS", "URL_MAX_KEYS",
+                 "REPORT_FORMAT", "REPORT_PAGE_SIZE", "GZIP_READER", "DIMENSIONS",
+                 "FOLLOW_INTERVAL", "FOLLOW_WINDOWS", "QUANTILE_MODE", "QUANTILE_ACCURACY", "PLAIN_READER",
+                 "PROFILE", "PROFILE_SAMPLE")
         for prop in props:
             value = None
 
@@ -267,9 +2071,28 @@ if __name__ == "__main__":
     # Обработка параметров скрипта
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", dest="config", help="config file", default="./config/config.conf")
+    parser.add_argument("--incremental", dest="incremental", action="store_true",
+                        help="refresh the latest report reading only lines added since the last run")
+    parser.add_argument("--rollup", dest="rollup", choices=("week", "month"),
+                        help="build a report for a week or month from daily aggregates in STATE_DIR")
+    parser.add_argument("--date", dest="date", help="rollup date YYYYMMDD (default: latest aggregated day)")
+    parser.add_argument("--convert", dest="convert", action="store_true",
+                        help="convert the latest log to the columnar format in COLUMNAR_DIR")
+    parser.add_argument("--profile", dest="profile",
+                        help="write per-stage timings and memory of the run to this json file")
+    parser.add_argument("--profile-sample", dest="profile_sample", type=int,
+                        help="with --profile: also break down and cProfile the first N lines of the log")
+    parser.add_argument("--follow", dest="follow", action="store_true",
+                        help="follow the latest log and refresh rolling-window reports every FOLLOW_INTERVAL seconds")
     args = parser.parse_args()
     config_file = args.config
     config = parse_config_file(config_file, config)
+    if args.incremental:
+        config["INCREMENTAL"] = True
+    if args.profile:
+        config["PROFILE"] = args.profile
+    if args.profile_sample:
+        config["PROFILE_SAMPLE"] = args.profile_sample
 
     # Инициализация лога и запуск скрипта
     init_log(config["SCRIPT_LOG"])
@@ -277,6 +2100,14 @@ if __name__ == "__main__":
     logging.info("Config file parsing complete")
 
     try:
-        main(config)
+        set_quantile_mode(config["QUANTILE_MODE"], float(config["QUANTILE_ACCURACY"]))
+        if args.rollup:
+            main_rollup(config, args.rollup, args.date)
+        elif args.convert:
+            main_convert(config)
+        elif args.follow:
+            main_follow(config)
+        else:
+            main(config)
     except:
         logging.exception("Exception raised")
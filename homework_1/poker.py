@@ -29,82 +29,469 @@
 
 import itertools
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# -----------------
+# Быстрая оценка по таблицам.
+# Карта - число suit * 13 + rank, rank 0..12 (2..A), suit 0..3 (C, D, H, S).
+# Значение руки - целое число: категория (как в hand_rank, 0..8) << 20 и ранги пяти карт (2..14)
+# по убыванию значимости в полубайтах, больше - сильнее. Флеш определяется по таблице FLUSH_TABLE
+# из 8192 масок рангов одной масти, остальные категории зависят только от числа карт каждого ранга:
+# ключ руки - сумма 5 ** rank по картам, значения по ключу считаются один раз и хранятся в RANK_TABLE.
+# Набор карт можно задать маской: бит suit * 13 + rank, 13 бит рангов на масть (hand_mask, mask_value).
+# -----------------
+
+RANKS = '23456789TJQKA'
+SUITS = 'CDHS'
+
+# Число карт каждой категории для рангов в значении руки (в порядке полубайтов)
+CATEGORY_COUNTS = {
+    8: (1, 1, 1, 1, 1),
+    7: (4, 1),
+    6: (3, 2),
+    5: (1, 1, 1, 1, 1),
+    4: (1, 1, 1, 1, 1),
+    3: (3, 1, 1),
+    2: (2, 2, 1),
+    1: (2, 1, 1, 1),
+    0: (1, 1, 1, 1, 1),
+}
+
+
+def card_index(card):
+    """Номер карты по строке ('AS' -> 51)"""
+    return CARD_INDEX[card]
+
+
+def card_name(index):
+    """Строка карты по номеру (51 -> 'AS')"""
+    return RANKS[index % 13] + SUITS[index // 13]
+
+
+def pack_value(category, ranks):
+    """Значение руки по категории и рангам (2..14) в порядке значимости"""
+    value = category
+    for i in range(5):
+        value = (value << 4) | (ranks[i] if i < len(ranks) else 0)
+    return value
+
+
+def value_category(value):
+    """Категория руки (0..8) по значению"""
+    return value >> 20
+
+
+def value_ranks(value):
+    """Ранги из значения руки (без пустых полубайтов)"""
+    ranks = [(value >> shift) & 0xF for shift in (16, 12, 8, 4, 0)]
+    return [r for r in ranks if r]
+
+
+def straight_ranks(mask):
+    """Ранги старшего стрита в маске рангов (бит rank), [] если стрита нет; A-2-3-4-5 - стрит до пятерки"""
+    for high in range(12, 3, -1):
+        if (mask >> (high - 4)) & 0x1F == 0x1F:
+            return [high - i + 2 for i in range(5)]
+    if mask & 0x100F == 0x100F:
+        return [5, 4, 3, 2, 14]
+    return []
+
+
+def _mask_ranks(mask):
+    return [rank + 2 for rank in range(12, -1, -1) if mask >> rank & 1]
+
+
+def _flush_value(mask):
+    """Значение флеша (или стрит-флеша) по маске рангов одной масти, 0 - меньше 5 карт"""
+    ranks = _mask_ranks(mask)
+    if len(ranks) < 5:
+        return 0
+    straight = straight_ranks(mask)
+    if straight:
+        return pack_value(8, straight)
+    return pack_value(5, ranks[:5])
+
+
+def _counts_value(key):
+    """Значение руки без флеша по ключу (сумма 5 ** rank)"""
+    counts = []
+    mask = 0
+    for rank in range(13):
+        count = key % 5
+        key //= 5
+        if count:
+            counts.append((count, rank + 2))
+            mask |= 1 << rank
+    counts.sort(reverse=True)
+    ranks = [r for c, r in counts]
+
+    if counts[0][0] == 4:
+        return pack_value(7, [ranks[0], max(ranks[1:])])
+    if counts[0][0] == 3 and counts[1][0] >= 2:
+        return pack_value(6, [ranks[0], max(r for c, r in counts[1:] if c >= 2)])
+    straight = straight_ranks(mask)
+    if straight:
+        return pack_value(4, straight)
+    if counts[0][0] == 3:
+        return pack_value(3, [ranks[0]] + sorted(ranks[1:], reverse=True)[:2])
+    if counts[0][0] == 2 and counts[1][0] == 2:
+        return pack_value(2, ranks[:2] + [max(ranks[2:])])
+    if counts[0][0] == 2:
+        return pack_value(1, [ranks[0]] + ranks[1:4])
+    return pack_value(0, ranks[:5])
+
+
+FLUSH_TABLE = [_flush_value(mask) for mask in range(1 << 13)]
+RANK_TABLE = {}
+RANK_KEYS = [5 ** (index % 13) for index in range(52)]
+RANK_BITS = [1 << (index % 13) for index in range(52)]
+CARD_INDEX = dict((RANKS[index % 13] + SUITS[index // 13], index) for index in range(52))
+MASK_KEYS = [sum(5 ** rank for rank in range(13) if mask >> rank & 1) for mask in range(1 << 13)]
+SUIT_SHIFTS = (0, 13, 26, 39)
+
+
+# Масти, которые может заменить джокер: черный - трефы и пики, красный - бубны и червы
+JOKER_SUITS = {'?B': (0, 3), '?R': (1, 2)}
+
+
+def eval_cards(cards):
+    """Значение лучшей пятикарточной комбинации из 5-7 карт (номера карт)"""
+    key = 0
+    suits = [0, 0, 0, 0]
+    for card in cards:
+        key += RANK_KEYS[card]
+        suits[card // 13] |= RANK_BITS[card]
+
+    # Из 7 карт при флеше каре и фулл-хаус невозможны, флеш старше остальных категорий
+    for mask in suits:
+        value = FLUSH_TABLE[mask]
+        if value:
+            return value
+
+    return _rank_value(key)
+
+
+def _rank_value(key):
+    """Значение руки без флеша по ключу рангов (из RANK_TABLE или с добавлением в нее)"""
+    value = RANK_TABLE.get(key)
+    if value is None:
+        value = RANK_TABLE[key] = _counts_value(key)
+    return value
+
+
+def wild_value(cards, jokers):
+    """Лучшее значение руки из номеров карт cards и джокеров jokers ('?B', '?R')
+    и номера карт, которыми заменяются джокеры (в порядке jokers).
+
+    Джокер заменяет карту своего цвета, которой нет в руке. Варианты не перебираются целиком:
+    комбинации без флеша зависят только от числа карт каждого ранга - перебираются ранги джокеров
+    (не больше 13 * 13 ключей RANK_TABLE); флеш по масти зависит от маски ее рангов и джокера этого цвета
+    (не больше 4 * 13 обращений к FLUSH_TABLE). Из 7 карт флеш старше любой комбинации без флеша.
+    """
+    present = set(cards)
+    key = 0
+    suits = [0, 0, 0, 0]
+    for card in cards:
+        key += RANK_KEYS[card]
+        suits[card // 13] |= RANK_BITS[card]
+
+    # Свободные карты цвета каждого джокера; для комбинаций без флеша важен только ранг
+    options = []
+    rank_options = []
+    for joker in jokers:
+        free = [suit * 13 + rank for rank in range(13) for suit in JOKER_SUITS[joker] if suit * 13 + rank not in present]
+        by_rank = {}
+        for card in free:
+            by_rank.setdefault(card % 13, card)
+        options.append(free)
+        rank_options.append(sorted(by_rank.values()))
+
+    best_value = -1
+    best_subst = None
+    for subst in itertools.product(*rank_options):
+        value = _rank_value(key + sum(RANK_KEYS[card] for card in subst))
+        if value > best_value:
+            best_value, best_subst = value, list(subst)
+
+    for suit in range(4):
+        # Джокер цвета этой масти дополняет маску, остальные заменяют любую свободную карту
+        value = FLUSH_TABLE[suits[suit]]
+        subst = [free[0] for free in options]
+        for i, joker in enumerate(jokers):
+            if suit in JOKER_SUITS[joker]:
+                for card in options[i]:
+                    if card // 13 == suit and FLUSH_TABLE[suits[suit] | RANK_BITS[card]] > value:
+                        value = FLUSH_TABLE[suits[suit] | RANK_BITS[card]]
+                        subst = [free[0] for free in options]
+                        subst[i] = card
+        if value > best_value:
+            best_value, best_subst = value, subst
+
+    return best_value, best_subst
+
+
+def hand_mask(hand):
+    """Маска карт 'руки' из строк карт (бит suit * 13 + rank)"""
+    mask = 0
+    for card in hand:
+        mask |= 1 << CARD_INDEX[card]
+    return mask
+
+
+def mask_value(mask):
+    """Значение лучшей пятикарточной комбинации по маске из 5-7 карт"""
+    key = 0
+    for shift in SUIT_SHIFTS:
+        suit = (mask >> shift) & 0x1FFF
+        if FLUSH_TABLE[suit]:
+            return FLUSH_TABLE[suit]
+        key += MASK_KEYS[suit]
+    return _rank_value(key)
+
+
+def hand_value(hand):
+    """Значение лучшей комбинации для 'руки' из строк карт"""
+    return eval_cards([CARD_INDEX[card] for card in hand])
+
+
+def hand_cards(hand, value):
+    """Пять карт 'руки', составляющие комбинацию со значением value"""
+    category = value_category(value)
+    cards = list(hand)
+    if category in (8, 5):
+        # Карты флеша - одной масти
+        suit = max(SUITS, key=lambda s: sum(1 for card in cards if card[1] == s))
+        cards = [card for card in cards if card[1] == suit]
+
+    result = []
+    for rank, count in zip(value_ranks(value), CATEGORY_COUNTS[category]):
+        chosen = [card for card in cards if card[0] == RANKS[rank - 2] and card not in result][:count]
+        result.extend(chosen)
+    return result
+
+
+# -----------------
+# Пакетная оценка средствами numpy: руки - массив (N, k) номеров карт, 5 <= k <= 7.
+# Значения считаются векторно по тем же правилам, что в eval_cards: флеш - по FLUSH_TABLE для маски
+# каждой масти, остальное - поиском ключа (сумма 5 ** rank) в отсортированном массиве ключей всех наборов
+# рангов из k карт (searchsorted). Позиции пяти карт комбинации восстанавливаются по значению.
+# Руки обрабатываются частями по BATCH_CHUNK строк.
+# -----------------
+
+BATCH_CHUNK = 65536
+_batch_tables = {}
+
+
+def encode_hands(hands):
+    """Руки из строк карт -> массив (N, k) номеров карт (uint8)"""
+    if np is None:
+        raise RuntimeError("numpy is required for batch evaluation")
+    return np.array([[CARD_INDEX[card] for card in hand] for hand in hands], dtype=np.uint8).reshape(len(hands), -1)
+
+
+def decode_hands(cards):
+    """Массив (N, k) номеров карт -> руки из строк карт"""
+    return [[card_name(index) for index in row] for row in np.asarray(cards).tolist()]
+
+
+def _get_batch_tables(size):
+    """Таблицы для пакетной оценки рук из size карт: отсортированные ключи наборов рангов и их значения
+    (строятся при первом вызове для данного size), значения флешей по маске, число карт по категориям"""
+    if size not in _batch_tables:
+        keys = []
+        for ranks in itertools.combinations_with_replacement(range(13), size):
+            if max(ranks.count(rank) for rank in set(ranks)) <= 4:
+                keys.append(sum(5 ** rank for rank in ranks))
+        keys.sort()
+        _batch_tables[size] = (np.array(keys, dtype=np.int32),
+                               np.array([_counts_value(key) for key in keys], dtype=np.int32))
+    if 'flush' not in _batch_tables:
+        _batch_tables['flush'] = np.array(FLUSH_TABLE, dtype=np.int32)
+        _batch_tables['powers'] = np.array([5 ** rank for rank in range(13)], dtype=np.int32)
+        _batch_tables['counts'] = np.array([CATEGORY_COUNTS[category] + (0,) * (5 - len(CATEGORY_COUNTS[category]))
+                                            for category in range(9)], dtype=np.int32)
+    return _batch_tables
+
+
+def eval_batch(cards, positions=True):
+    """Значения лучших комбинаций и позиции (номера столбцов) пяти карт, которые ее составляют.
+
+    cards - массив (N, k) номеров карт, 5 <= k <= 7.
+    Возвращает values (N,) int32 - те же значения, что eval_cards, и best (N, 5) - позиции карт лучшей пятерки
+    (при positions=False - только values, это заметно быстрее).
+    """
+    if np is None:
+        raise RuntimeError("numpy is required for batch evaluation")
+
+    cards = np.asarray(cards)
+    values = np.empty(len(cards), dtype=np.int32)
+    best = np.empty((len(cards), 5), dtype=np.intp)
+    for start in range(0, len(cards), BATCH_CHUNK):
+        chunk = cards[start:start + BATCH_CHUNK].astype(np.int32)
+        ranks = chunk % 13
+        suits = chunk // 13
+        chunk_values, flush_suit = _eval_chunk(ranks, suits)
+        values[start:start + len(chunk)] = chunk_values
+        if positions:
+            best[start:start + len(chunk)] = _best_positions(chunk_values, ranks, suits, flush_suit)
+    if positions:
+        return values, best
+    return values
+
+
+def _eval_chunk(ranks, suits):
+    """Значения рук и масть флеша (-1, если флеша нет)"""
+    tables = _get_batch_tables(ranks.shape[1])
+    keys_table, values_table = tables[ranks.shape[1]]
+    rows = np.arange(len(ranks))
+    bits = np.left_shift(1, ranks)
+
+    # Маски рангов по мастям (ранги внутри масти различны, сумма равна OR); флеш из 7 карт старше остального
+    suit_masks = np.zeros((len(ranks), 4), dtype=np.int32)
+    for suit in range(4):
+        suit_masks[:, suit] = np.where(suits == suit, bits, 0).sum(axis=1)
+    flush_suit = tables['flush'][suit_masks].argmax(axis=1)
+    flush_values = tables['flush'][suit_masks[rows, flush_suit]]
+    rank_values = values_table[np.searchsorted(keys_table, tables['powers'][ranks].sum(axis=1))]
+    is_flush = flush_values > 0
+    return np.where(is_flush, flush_values, rank_values), np.where(is_flush, flush_suit, -1)
+
+
+def _best_positions(values, ranks, suits, flush_suit):
+    """Позиции пяти карт комбинации со значением values (первые подходящие карты слева направо)"""
+    tables = _get_batch_tables(ranks.shape[1])
+    rows = np.arange(len(ranks))
+
+    # Сколько карт каждого ранга (2..14) входит в комбинацию - по полубайтам значения и категории
+    categories = values >> 20
+    need = np.zeros((len(ranks), 15), dtype=np.int32)
+    for i, shift in enumerate((16, 12, 8, 4, 0)):
+        need[rows, (values >> shift) & 0xF] += tables['counts'][categories, i]
+    need[:, 0] = 0
+
+    # Карты берутся слева направо, для флеша - только нужной масти
+    any_suit = flush_suit < 0
+    taken = np.zeros(ranks.shape, dtype=bool)
+    for col in range(ranks.shape[1]):
+        rank_col = ranks[:, col] + 2
+        take = (need[rows, rank_col] > 0) & (any_suit | (suits[:, col] == flush_suit))
+        need[rows[take], rank_col[take]] -= 1
+        taken[:, col] = take
+    return np.argsort(~taken, axis=1, kind='mergesort')[:, :5]
+
+
+# Значения hand_rank по каноническому ключу пятикарточной руки: масти важны только для флеша,
+# поэтому ключ - сумма 5 ** rank по картам * 2 + признак флеша (не больше 7462 различных ключей)
+HAND_RANK_TABLE = {}
+
+
 def hand_rank(hand):
-    """Возвращает значение определяющее ранг 'руки'"""
-    ranks = card_ranks(hand)
-    if straight(ranks) and flush(hand):
-        return (8, [max(ranks)], [])
-    elif kind(4, ranks):
-        return (7, kind(4, ranks), kind(1, ranks))
-    elif kind(3, ranks) and kind(2, ranks):
-        return (6, kind(3, ranks), kind(2, ranks))
-    elif flush(hand):
-        return (5, ranks, [])
-    elif straight(ranks):
-        return (4, [max(ranks)], [])
-    elif kind(3, ranks):
-        return (3, kind(3, ranks), ranks)
-    elif two_pair(ranks):
-        return (2, two_pair(ranks), ranks)
-    elif kind(2, ranks):
-        return (1, kind(2, ranks), ranks)
+    """Возвращает значение определяющее ранг 'руки' из 5 карт без джокеров
+    (руки с джокерами оцениваются через best_wild_hand)"""
+    try:
+        mask = hand_mask(hand)
+    except KeyError as e:
+        raise ValueError("hand_rank does not accept jokers or unknown cards: %s" % e.args[0])
+    return mask_rank(mask)
+
+
+def mask_rank(mask):
+    """hand_rank по маске из 5 карт: (категория, старшие ранги, ранги для сравнения), значения
+    кэшируются в HAND_RANK_TABLE"""
+    key = 0
+    flush = 0
+    for shift in SUIT_SHIFTS:
+        suit = (mask >> shift) & 0x1FFF
+        key += MASK_KEYS[suit]
+        if FLUSH_TABLE[suit]:
+            flush = 1
+    rank = HAND_RANK_TABLE.get(key * 2 + flush)
+    if rank is None:
+        rank = HAND_RANK_TABLE[key * 2 + flush] = _rank_tuple(key, flush)
+    return rank
+
+
+def _rank_tuple(key, flush):
+    """Значение hand_rank по ключу рангов и признаку флеша"""
+    ranks = _key_ranks(key)
+    if flush:
+        mask = sum(1 << (rank - 2) for rank in ranks)
+        value = FLUSH_TABLE[mask]
     else:
-        return (0, ranks, [])
+        value = _rank_value(key)
+    category = value_category(value)
+    top = tuple(value_ranks(value))
+    ranks = tuple(ranks)
+
+    if category in (8, 4):
+        return (category, top[:1], ())
+    if category in (7, 6):
+        return (category, top[:1], top[1:2])
+    if category in (5, 0):
+        return (category, ranks, ())
+    if category == 2:
+        return (category, top[:2], ranks)
+    return (category, top[:1], ranks)
+
+
+def _key_ranks(key):
+    """Ранги карт (2..14) по ключу (сумма 5 ** rank), от большего к меньшему"""
+    ranks = []
+    for rank in range(13):
+        ranks.extend([rank + 2] * (key % 5))
+        key //= 5
+    return sorted(ranks, reverse=True)
+
+
+RANK_VALUES = dict((rank, index + 2) for index, rank in enumerate(RANKS))
 
 
 def real_value(rank):
     """Возвращает реальную ценность карты (для сравнения)"""
-    cr = ['2', '3', '4', '5', '6', '7', '8', '9', 'T', 'J', 'Q', 'K', 'A']
-    rn = [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]
-    for ls in zip(cr, rn):
-        if rank == ls[0]:
-            return ls[1]
+    return RANK_VALUES.get(rank)
 
 
 def card_ranks(hand):
     """Возвращает список рангов (его числовой эквивалент),
     отсортированный от большего к меньшему"""
-    list = [x[0] for x in hand if x[0] != '?']
-    list = sorted([real_value(x) for x in list], reverse=True)
-    return list
+    return sorted((CARD_INDEX[card] % 13 + 2 for card in hand if card[0] != '?'), reverse=True)
 
 
 def flush(hand):
     """Возвращает True, если все карты одной масти"""
-    list = [x[1] for x in hand]
-    list = set(list)
-    return len(list) == 1
+    mask = hand_mask(hand)
+    return sum(1 for shift in SUIT_SHIFTS if (mask >> shift) & 0x1FFF) == 1
 
 
 def straight(ranks):
-    """Возвращает True, если отсортированные ранги формируют последовательность 5ти,
-    где у 5ти карт ранги идут по порядку (стрит)"""
-    for i in range(0, len(ranks) - 4):
-        rv = [x for x in ranks[i:i+5]]
-        value_range = max(rv) - min(rv)
-        if (value_range == 4 and len(set(rv)) == 5):
-            return True
-    return False
+    """Возвращает True, если ранги формируют последовательность 5ти,
+    где у 5ти карт ранги идут по порядку (стрит); A-2-3-4-5 - стрит до пятерки"""
+    return bool(straight_ranks(sum(1 << (rank - 2) for rank in set(ranks))))
 
 
 def kind(n, ranks):
     """Возвращает первый ранг, который n раз встречается в данной руке.
     Возвращает None, если ничего не найдено"""
+    counts = [0] * 15
+    for r in ranks:
+        counts[r] += 1
     for r in ranks:
-        if ranks.count(r) == n:
+        if counts[r] == n:
             return [r]
 
 
 def two_pair(ranks):
     """Если есть две пары, то возврщает два соответствующих ранга,
     иначе возвращает None"""
-    counts = {}
+    counts = [0] * 15
     for r in ranks:
-        if r not in counts:
-            counts[r] = 0
         counts[r] += 1
-    vals = [key for key in counts.keys() if counts[key]==2]
-    return vals
+    vals = [r for r in range(14, 1, -1) if counts[r] == 2]
+    if len(vals) >= 2:
+        return vals
 
 
 def check_comb(cb, best):
@@ -131,7 +518,12 @@ def check_comb(cb, best):
 
 
 def best_hand(hand):
-    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт """
+    """Из "руки" в 7 карт возвращает лучшую "руку" в 5 карт (оценка по таблицам)"""
+    return sorted(hand_cards(hand, hand_value(hand)))
+
+
+def best_hand_reference(hand):
+    """best_hand перебором 21 комбинации через hand_rank - для сверки"""
     best = {'comb': '', 'val': [0, 0, 0]}
 
     for cb in itertools.combinations(hand, 5):
@@ -141,14 +533,25 @@ def best_hand(hand):
 
 
 def best_wild_hand(hand):
-    """best_hand но с джокерами"""
+    """best_hand но с джокерами: лучшая замена джокеров находится по гистограммам рангов и мастей (wild_value)"""
+    cards = [card for card in hand if card[0] != '?']
+    jokers = [card for card in hand if card[0] == '?']
+    if not jokers:
+        return best_hand(hand)
+
+    value, subst = wild_value([CARD_INDEX[card] for card in cards], jokers)
+    return sorted(hand_cards(cards + [card_name(card) for card in subst], value))
+
+
+def best_wild_hand_reference(hand):
+    """best_wild_hand перебором всех замен джокеров и 21 комбинации через hand_rank - для сверки"""
 
     best = {'comb': '', 'val': [0, 0, 0]}
 
     # Варианты замены джокера для данной руки
     jokers = get_jokers(hand)
 
-    hand_wrap = [hand]
+    hand_wrap = [list(hand)]
 
     # Замена джокеров на все варианты, создание списка комбинаций
     hand_wrap = replace_jokers(hand_wrap, jokers)
@@ -213,6 +616,50 @@ def test_best_hand():
     print 'OK'
 
 
+def test_hand_value():
+    print "test_hand_value..."
+    import random
+    rnd = random.Random(1)
+    deck = [r + s for r in RANKS for s in SUITS]
+    assert hand_value("AS KS QS JS TS".split()) == pack_value(8, [14, 13, 12, 11, 10])
+    assert hand_value("5D 4C 3H 2S AD 9C 9D".split()) == pack_value(4, [5, 4, 3, 2, 14])
+    assert hand_value("9C 9D 9H 5S 5D 5C 2H".split()) == pack_value(6, [9, 5])
+    assert hand_value("KC KD 7H 7S 3D 3C AH".split()) == pack_value(2, [13, 7, 14])
+    assert hand_value("2C 3C 4C 5C 7C 8D 9H".split()) > hand_value("5D 6H 7S 8C 9D 2H 2D".split())
+    for _ in range(1000):
+        hand = rnd.sample(deck, 7)
+        value = hand_value(hand)
+        # Значение 7 карт - максимум по 21 пятикарточной комбинации, категории совпадают с hand_rank
+        assert value == max(hand_value(cb) for cb in itertools.combinations(hand, 5))
+        cards = hand_cards(hand, value)
+        assert len(set(cards)) == 5 and set(cards) <= set(hand) and hand_value(cards) == value
+        if value_category(value) != 4 or value_ranks(value)[0] != 5:
+            assert value_category(value) == max(hand_rank(cb)[0] for cb in itertools.combinations(hand, 5))
+    print 'OK'
+
+
+def test_eval_batch():
+    print "test_eval_batch..."
+    if np is None:
+        print 'numpy is not installed, skipped'
+        return
+    import random
+    rnd = random.Random(2)
+    deck = [r + s for r in RANKS for s in SUITS]
+    hands = [rnd.sample(deck, 7) for _ in range(2000)] + ["6C 7C 8C 9C TC 5C JS".split()]
+    cards = encode_hands(hands)
+    assert cards.shape == (2001, 7) and decode_hands(cards) == hands
+    values, best = eval_batch(cards)
+    for hand, value, five in zip(hands, values.tolist(), best.tolist()):
+        assert value == hand_value(hand)
+        assert hand_value([hand[i] for i in five]) == value
+    assert sorted(hands[-1][i] for i in best[-1]) == ['6C', '7C', '8C', '9C', 'TC']
+
+    values = eval_batch(encode_hands([hand[:6] for hand in hands]), positions=False)
+    assert values.tolist() == [hand_value(hand[:6]) for hand in hands]
+    print 'OK'
+
+
 def test_best_wild_hand():
     print "test_best_wild_hand..."
     assert (sorted(best_wild_hand("6C 7C 8C 9C TC 5C ?B".split()))
@@ -223,6 +670,57 @@ def test_best_wild_hand():
             == ['7C', '7D', '7H', '7S', 'JD'])
     print 'OK'
 
+def test_wild_value():
+    print "test_wild_value..."
+    import random
+    rnd = random.Random(3)
+    deck = [r + s for r in RANKS for s in SUITS]
+    for _ in range(300):
+        jokers = rnd.choice((['?B'], ['?R'], ['?B', '?R']))
+        hand = rnd.sample(deck, 7 - len(jokers)) + jokers
+
+        # Лучшее значение совпадает с полным перебором замен джокеров
+        variants = replace_jokers([list(hand)], get_jokers(hand))
+        expected = max(hand_value(variant) for variant in variants if len(set(variant)) == 7)
+        best = best_wild_hand(hand)
+        assert hand_value(best) == expected
+        assert len(set(best)) == 5
+        assert set(best) - set(hand) <= set(card for variant in variants for card in variant)
+    print 'OK'
+
+
+def test_hand_rank():
+    print "test_hand_rank..."
+    assert hand_rank("JC TC 9C 8C 7C".split()) == (8, (11,), ())
+    assert hand_rank("5S 5H 5D 5C KD".split()) == (7, (5,), (13,))
+    assert hand_rank("5S 5H 5D KC KD".split()) == (6, (5,), (13,))
+    assert hand_rank("AD 5D 4D 3S 2C".split()) == (4, (5,), ())
+    assert hand_rank("QD QS 5D 5S 2C".split()) == (2, (12, 5), (12, 12, 5, 5, 2))
+    assert hand_rank("QD 9S 5D 3S 2C".split()) == (0, (12, 9, 5, 3, 2), ())
+
+    # Порядок hand_rank совпадает с порядком hand_value
+    import random
+    rnd = random.Random(5)
+    deck = [r + s for r in RANKS for s in SUITS]
+    hands = [rnd.sample(deck, 5) for _ in range(2000)]
+    for a, b in zip(hands, hands[1:]):
+        assert cmp(hand_rank(a), hand_rank(b)) == cmp(hand_value(a), hand_value(b))
+        assert mask_value(hand_mask(a)) == hand_value(a)
+    assert len(HAND_RANK_TABLE) <= 7462
+
+    # Джокеры hand_rank не принимает
+    try:
+        hand_rank("?B KD KS 5C 2D".split())
+        assert False
+    except ValueError:
+        pass
+    print 'OK'
+
+
 if __name__ == '__main__':
+    test_hand_value()
+    test_hand_rank()
+    test_eval_batch()
     test_best_hand()
+    test_wild_value()
     test_best_wild_hand()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+import equity as eq
+import poker
+import unittest
+import itertools
+import os
+import sys
+import subprocess
+
+
+class EquityTest(unittest.TestCase):
+
+    def test_river(self):
+        """Тестирование эквити при открытом борде: победитель определяется сравнением рук"""
+
+        result = eq.equity(["AS KS", "QH QD"], "KD 7C 2H 9S 3D")
+        self.assertTrue(result.exhaustive)
+        self.assertEqual(result.boards, 1)
+        self.assertEqual([player.win for player in result.players], [1.0, 0.0])
+
+        # Стрит на борде - банк делится
+        result = eq.equity(["AS KS", "QH QD", "2C 2D"], "5C 6D 7H 8S 9D")
+        self.assertEqual([player.tie for player in result.players], [1.0, 1.0, 1.0])
+        for player in result.players:
+            self.assertAlmostEqual(player.equity, 1.0 / 3)
+
+    def test_exhaustive(self):
+        """Тестирование полного перебора на флопе: совпадает с прямым сравнением hand_value"""
+
+        hands = [["AS", "KD"], ["QH", "QD"], ["7C", "8C"]]
+        board = ["2C", "9C", "JD"]
+        deck = [r + s for r in poker.RANKS for s in poker.SUITS if r + s not in sum(hands, board)]
+        wins = [0, 0, 0]
+        total = 0
+        for runout in itertools.combinations(deck, 2):
+            values = [poker.hand_value(hand + board + list(runout)) for hand in hands]
+            if values.count(max(values)) == 1:
+                wins[values.index(max(values))] += 1
+            total += 1
+
+        numpy = eq.np
+        try:
+            # С numpy (eval_batch) и без него (eval_cards)
+            for module in (numpy, None):
+                eq.np = module
+                result = eq.equity(hands, board)
+                self.assertTrue(result.exhaustive)
+                self.assertEqual(result.boards, total)
+                self.assertEqual([int(round(player.win * total)) for player in result.players], wins)
+                self.assertAlmostEqual(sum(player.equity for player in result.players), 1.0)
+        finally:
+            eq.np = numpy
+
+    def test_monte_carlo(self):
+        """Тестирование Монте-Карло: результат определяется seed и не зависит от числа процессов"""
+
+        hands = ["AS AH", "KS KH"]
+        first = eq.equity(hands, trials=30000, seed=5)
+        self.assertFalse(first.exhaustive)
+        self.assertEqual(first.boards, 30000)
+        self.assertEqual(eq.equity(hands, trials=30000, seed=5), first)
+        self.assertEqual(eq.equity(hands, trials=30000, seed=5, workers=2), first)
+        self.assertNotEqual(eq.equity(hands, trials=30000, seed=6), first)
+
+        # Точное значение для AA против KK - 82.64%
+        self.assertAlmostEqual(first.players[0].equity, 0.8264, delta=0.01)
+
+        # Результат не зависит от PYTHONHASHSEED
+        code = 'import equity; print repr(equity.equity(["AS AH", "KS KH"], trials=30000, seed=5).players[0].equity)'
+        self.assertEqual(run_with_hash_seeds(code), [repr(first.players[0].equity)] * 2)
+
+    def test_hand_classes(self):
+        """Тестирование классов стартовых рук"""
+
+        classes = eq.hand_classes()
+        self.assertEqual(len(classes), 169)
+        self.assertEqual(classes[:3], ['AA', 'AKs', 'AKo'])
+        self.assertEqual(eq.hand_class("KS AS"), 'AKs')
+        self.assertEqual(eq.hand_class("2D 7C"), '72o')
+        self.assertEqual(eq.hand_class("TH TC"), 'TT')
+
+    @unittest.skipIf(eq.np is None, "numpy is not installed")
+    def test_equity_matrix(self):
+        """Тестирование матрицы эквити классов: совпадает со средним equity по всем парам рук"""
+
+        board = "2C 7D 9H 4S"
+        result = eq.equity_matrix(board)
+        self.assertTrue(result.exhaustive)
+        self.assertEqual(result.boards, 48)
+        index = dict((name, i) for i, name in enumerate(result.classes))
+        known = set(board.split())
+        deck = [r + s for r in poker.RANKS for s in poker.SUITS if r + s not in known]
+
+        combos = {}
+        for hand in itertools.combinations(deck, 2):
+            combos.setdefault(eq.hand_class(hand), []).append(hand)
+
+        for first, second in (('AA', 'KK'), ('T8o', 'JTs'), ('72o', 'AKs')):
+            total = 0.0
+            pairs = 0
+            for a in combos[first]:
+                for b in combos[second]:
+                    if not set(a) & set(b):
+                        total += eq.equity([a, b], board).players[0].equity
+                        pairs += 1
+            self.assertAlmostEqual(result.equity[index[first]][index[second]], total / pairs)
+
+        # Эквити класса против класса и обратно в сумме - 1; у 99 против 99 нет непересекающихся рук
+        matrix = result.equity
+        known = ~eq.np.isnan(matrix)
+        self.assertTrue(eq.np.allclose((matrix + matrix.T)[known], 1.0))
+        self.assertTrue(eq.np.isnan(matrix[index['99']][index['99']]))
+
+        # Монте-Карло по префлопу определяется seed и не зависит от числа процессов
+        first = eq.equity_matrix(trials=150, seed=3)
+        self.assertFalse(first.exhaustive)
+        second = eq.equity_matrix(trials=150, seed=3, workers=2)
+        self.assertTrue(eq.np.array_equal(first.equity, second.equity))
+
+        # и не зависит от PYTHONHASHSEED
+        code = 'import equity; print repr(equity.equity_matrix(trials=20, seed=3).equity[0][1])'
+        self.assertEqual(run_with_hash_seeds(code), [repr(eq.equity_matrix(trials=20, seed=3).equity[0][1])] * 2)
+
+    def test_errors(self):
+        """Тестирование проверки входных данных"""
+
+        self.assertRaises(ValueError, eq.equity, ["AS KS"])
+        self.assertRaises(ValueError, eq.equity, ["AS KS", "AS QD"])
+        self.assertRaises(ValueError, eq.equity, ["AS KS", "QH"])
+        self.assertRaises(ValueError, eq.equity, ["AS KS", "QH QD"], "2C 3C 4C 5C 6C 7C")
+        self.assertRaises(ValueError, eq.equity, ["AS KS", "QH XD"])
+        self.assertRaises(ValueError, eq.equity, ["AS KS", "QH QD"], trials=0)
+        self.assertRaises(ValueError, eq.equity, ["AS KS", "QH QD"], "2C 3C 4C", trials=-5)
+        if eq.np is not None:
+            self.assertRaises(ValueError, eq.equity_matrix, trials=0)
+            self.assertRaises(ValueError, eq.equity_matrix, "2C 3C 4C", trials=-1)
+
+
+def run_with_hash_seeds(code, hash_seeds=('1', '2')):
+    """Вывод code в отдельных процессах Python с разными PYTHONHASHSEED"""
+
+    outputs = []
+    for hash_seed in hash_seeds:
+        env = dict(os.environ, PYTHONHASHSEED=hash_seed)
+        process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE, env=env,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        outputs.append(process.communicate()[0].strip())
+    return outputs
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,12 @@
 import log_analyzer as la
 import unittest
 import os
+import random
+import gzip
+import shutil
+import tempfile
+import datetime
+import json
 
 class LogAnalyzerTest(unittest.TestCase):
 
@@ -27,6 +33,55 @@ class LogAnalyzerTest(unittest.TestCase):
         self.assertEqual(latest.date, date_form)
 
 
+    def test_dir_index(self):
+        """Тестирование кеша списка файлов лога: поиск последних файлов и диапазона дат"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            logdir = os.path.join(tmpdir, 'log')
+            index_path = os.path.join(tmpdir, 'state', 'index', 'dirs.json')
+            os.makedirs(logdir)
+            for name in ('nginx-test-ui.log-20170630', 'nginx-test-ui.log-20170701.gz', 'nginx-test-ui.log-20170625',
+                         'nginx-test-ui.log-20171345', 'nginx-test-ui.log-20170702.bz2', 'nginx-test-uiXlog-20170703',
+                         'other.log-20170704'):
+                open(os.path.join(logdir, name), 'w').close()
+
+            latest = la.get_latest_file(logdir, 'nginx-test-ui.log', index_path)
+            self.assertEqual(latest, la.LastData('nginx-test-ui.log-20170701.gz', '2017.07.01'))
+            self.assertTrue(os.path.exists(index_path))
+
+            # Пока каталог не менялся, он не перечитывается
+            listdir = la.os.listdir
+            la.os.listdir = None
+            try:
+                latest = la.get_latest_files(logdir, 'nginx-test-ui.log', 2, index_path)
+                self.assertEqual([item.filename for item in latest],
+                                 ['nginx-test-ui.log-20170701.gz', 'nginx-test-ui.log-20170630'])
+                self.assertEqual(type(latest[0].filename), str)
+                found = la.find_log_files(logdir, 'nginx-test-ui.log', datetime.datetime(2017, 6, 25),
+                                          datetime.datetime(2017, 6, 30), index_path)
+                self.assertEqual([item.date for item in found], ['2017.06.25', '2017.06.30'])
+            finally:
+                la.os.listdir = listdir
+
+            # Новый файл меняет mtime каталога - кеш обновляется
+            open(os.path.join(logdir, 'nginx-test-ui.log-20170705'), 'w').close()
+            self.assertEqual(la.get_latest_file(logdir, 'nginx-test-ui.log', index_path).date, '2017.07.05')
+            self.assertEqual(la.get_latest_file(os.path.join(tmpdir, 'none'), 'nginx-test-ui.log'),
+                             la.LastData(None, None))
+            self.assertEqual(os.listdir(os.path.dirname(index_path)), ['dirs.json'])
+
+            # Кеш не записывается (вместо каталога - файл) - список файлов все равно возвращается
+            blocked_path = os.path.join(tmpdir, 'blocked', 'dirs.json')
+            open(os.path.join(tmpdir, 'blocked'), 'w').close()
+            self.assertEqual(la.get_latest_file(logdir, 'nginx-test-ui.log', blocked_path).date, '2017.07.05')
+            os.remove(os.path.join(tmpdir, 'blocked'))
+            os.makedirs(os.path.join(tmpdir, 'blocked', 'dirs.json'))
+            self.assertEqual(la.get_latest_file(logdir, 'nginx-test-ui.log', blocked_path).date, '2017.07.05')
+            self.assertEqual(os.listdir(os.path.join(tmpdir, 'blocked')), ['dirs.json'])
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_prepare_stats(self):
         """Тестирование подготовки сводных данных"""
 
@@ -45,8 +100,12 @@ class LogAnalyzerTest(unittest.TestCase):
 
         stats = la.prepare_stats(la.read_lines(logdir + '/' + file_name, 0.95))
 
-        self.assertEqual(stats.data['/api/v2/banner/25022354'][0], 0.27)
-        self.assertEqual(stats.data['/api/v2/banner/25019354'][1], 0.33)
+        self.assertEqual(stats.data['/api/v2/banner/25022354'].count, 1)
+        self.assertEqual(stats.data['/api/v2/banner/25022354'].time_max, 0.27)
+        self.assertEqual(stats.data['/api/v2/banner/25019354'].count, 3)
+        self.assertAlmostEqual(stats.data['/api/v2/banner/25019354'].time_sum, 2.05)
+        self.assertEqual(stats.data['/api/v2/banner/25019354'].median(), 0.39)
+        self.assertEqual(stats.requests_total, 4)
 
         os.unlink(logdir + '/' + file_name)
 
@@ -62,5 +121,690 @@ class LogAnalyzerTest(unittest.TestCase):
         self.assertEqual(log['request_time'], request_time)
 
 
+    def test_project_line(self):
+        """Тестирование быстрого извлечения полей: совпадает с полным регулярным выражением"""
+
+        lines = make_log_lines(20) + [
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "0" 400 166 "-" "-" "-" "-" "-" 0.000\n',
+            '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /a\\"b HTTP/1.1" 200 1 "-" "-" "-" "-" "-" 0.100\n',
+        ]
+        for line in lines:
+            self.assertEqual(la.project_line(line), la.project_line(line, validate=True))
+            self.assertEqual(la.project_line(line, la.COLNAMES), la.process_line(line) and
+                             tuple(la.process_line(line)[name] for name in la.COLNAMES))
+
+        self.assertEqual(la.project_line('broken " line\n'), None)
+        self.assertEqual(la.project_line('"' * 12 + ' abc\n', la.COLNAMES), None)
+
+    def test_quantile_sketch(self):
+        """Тестирование оценки медианы с ограниченной памятью"""
+
+        rnd = random.Random(1)
+        values = [round(rnd.uniform(0.001, 5.0), 3) for _ in range(5000)]
+
+        # Пока значений немного - медиана точная
+        small = la.QuantileSketch()
+        for value in values[:la.SKETCH_EXACT_LIMIT]:
+            small.add(value)
+        self.assertEqual(small.quantile(0.5), la.median(values[:la.SKETCH_EXACT_LIMIT]))
+
+        # Дальше - с относительной погрешностью SKETCH_ACCURACY, в том числе после слияния
+        left = la.QuantileSketch()
+        right = la.QuantileSketch()
+        for value in values[:2500]:
+            left.add(value)
+        for value in values[2500:]:
+            right.add(value)
+        left.merge(right)
+
+        exact = la.median(values)
+        self.assertEqual(left.count, len(values))
+        self.assertTrue(len(left.buckets) < 1000)
+        self.assertTrue(abs(left.quantile(0.5) - exact) <= exact * la.SKETCH_ACCURACY * 1.01)
+
+
+    def test_quantile_modes(self):
+        """Тестирование режимов оценки квантилей и границы погрешности в отчете"""
+
+        rnd = random.Random(3)
+        values = [round(rnd.uniform(0.001, 5.0), 3) for _ in range(2000)]
+        stats = la.prepare_stats([('GET /api/1 HTTP/1.1', str(value)) for value in values])
+        self.assertRaises(ValueError, la.set_quantile_mode, 'tdigest')
+        self.assertRaises(ValueError, la.set_quantile_mode, 'sketch', 1.5)
+        try:
+            # exact - все значения хранятся, медиана точная
+            la.set_quantile_mode('exact')
+            sketch = la.QuantileSketch()
+            for value in values:
+                sketch.add(value)
+            self.assertEqual(len(sketch.values), len(values))
+            self.assertEqual(sketch.quantile(0.5), la.median(values))
+            stats = la.prepare_stats([('GET /api/1 HTTP/1.1', str(value)) for value in values])
+            self.assertNotIn('time_med_err', la.make_final_list(stats, 1)[0])
+
+            # sketch - сразу гистограмма с заданной погрешностью, граница погрешности выводится в отчете
+            la.set_quantile_mode('sketch', 0.05)
+            sketch = la.QuantileSketch()
+            for value in values[:10]:
+                sketch.add(value)
+            self.assertEqual(sketch.values, [])
+            stats = la.prepare_stats([('GET /api/1 HTTP/1.1', str(value)) for value in values])
+            row = la.make_final_list(stats, 1)[0]
+            self.assertTrue(len(stats.data['/api/1'].times.buckets) < 200)
+            self.assertTrue(row['time_med_err'] > 0)
+            self.assertTrue(abs(row['time_med'] - la.median(values)) <= row['time_med_err'] + 0.001)
+
+            # Сводные данные с другим режимом или погрешностью не продолжаются и не объединяются
+            self.assertFalse(la.state_compatible({'dimensions': []}))
+            self.assertFalse(la.state_compatible({'dimensions': [], 'quantile_accuracy': 0.05}))
+            self.assertTrue(la.state_compatible({'dimensions': [], 'quantile_mode': 'sketch',
+                                                 'quantile_accuracy': 0.05}))
+
+            # hybrid - граница погрешности во всех строках, если хоть одна медиана оценена по гистограмме
+            la.set_quantile_mode('hybrid')
+            stats = la.prepare_stats([('GET /api/1 HTTP/1.1', str(value)) for value in values] +
+                                     [('GET /api/2 HTTP/1.1', '0.5')] * 3)
+            rows = la.make_final_list(stats, 2)
+            self.assertTrue(rows[0]['time_med_err'] > 0)
+            self.assertEqual(rows[1]['time_med_err'], 0)
+            self.assertNotIn('time_med_err', la.make_final_list(la.prepare_stats([('GET /api/2 HTTP/1.1', '0.5')]), 1)[0])
+
+            # State, собранный в hybrid, в режиме exact не продолжается: день пересчитывается, медиана точная
+            tmpdir = tempfile.mkdtemp()
+            try:
+                log_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623')
+                state_path = la.state_file_path(os.path.join(tmpdir, 'state'), os.path.basename(log_path))
+                with open(log_path, 'w') as log:
+                    log.writelines(make_log_lines(5000, urls=1))
+                expected = la.median([float(line.split()[-1]) for line in make_log_lines(5000, urls=1)])
+                stats = la.prepare_stats_incremental(log_path, state_path, 0.95)
+                self.assertEqual(la.load_state(state_path)['quantile_mode'], 'hybrid')
+                self.assertTrue(stats.data['/api/v2/banner/1'].times.buckets is not None)
+
+                la.set_quantile_mode('exact')
+                stats = la.prepare_stats_incremental(log_path, state_path, 0.95)
+                row = la.make_final_list(stats, 1)[0]
+                self.assertEqual(row['time_med'], round(expected, 3))
+                self.assertNotIn('time_med_err', row)
+                self.assertEqual(la.load_state(state_path)['quantile_mode'], 'exact')
+            finally:
+                shutil.rmtree(tmpdir)
+        finally:
+            la.set_quantile_mode('hybrid')
+
+    def test_prepare_stats_parallel(self):
+        """Тестирование параллельной обработки plain и gzip логов"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            plain_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623')
+            gz_path = plain_path + '.gz'
+            lines = make_log_lines(3000)
+            with open(plain_path, 'w') as log:
+                log.writelines(lines)
+            with gzip.open(gz_path, 'wb') as log:
+                log.writelines(lines)
+
+            expected = la.prepare_stats(la.read_lines(plain_path, 0.95))
+            for path in (plain_path, gz_path):
+                stats = la.prepare_stats_parallel(path, 0.95, 3)
+                self.assertEqual(stats.requests_total, expected.requests_total)
+                self.assertAlmostEqual(stats.time_total, expected.time_total)
+                self.assertEqual(sorted(stats.data.keys()), sorted(expected.data.keys()))
+                for key, url_stats in expected.data.iteritems():
+                    self.assertEqual(stats.data[key].count, url_stats.count)
+                    self.assertEqual(stats.data[key].time_max, url_stats.time_max)
+                    self.assertEqual(stats.data[key].median(), url_stats.median())
+
+            # Доля ошибок считается по всему файлу, а не по кускам
+            with open(plain_path, 'a') as log:
+                log.writelines(['broken line\n'] * 300)
+            self.assertRaises(RuntimeError, la.prepare_stats_parallel, plain_path, 0.95, 3)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_prepare_stats_incremental(self):
+        """Тестирование дочитывания растущего лога с сохранением состояния"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623')
+            state_path = os.path.join(tmpdir, 'state', 'nginx-test-ui.log-20170623.state.json.gz')
+            lines = make_log_lines(1000, urls=5)
+
+            # Первый запуск: часть строк и недописанная строка в конце
+            with open(log_path, 'w') as log:
+                log.writelines(lines[:600])
+                log.write(lines[600][:40])
+            stats = la.prepare_stats_incremental(log_path, state_path, 0.95)
+            self.assertEqual(stats.requests_total, 600)
+
+            # Второй запуск: дописанный хвост читается с сохраненного смещения
+            with open(log_path, 'a') as log:
+                log.write(lines[600][40:])
+                log.writelines(lines[601:])
+            stats = la.prepare_stats_incremental(log_path, state_path, 0.95)
+            expected = la.prepare_stats(la.read_lines(log_path, 0.95))
+
+            self.assertEqual(la.load_state(state_path)['offset'], os.path.getsize(log_path))
+            self.assertEqual(stats.requests_total, expected.requests_total)
+            self.assertAlmostEqual(stats.time_total, expected.time_total)
+            for key, url_stats in expected.data.iteritems():
+                self.assertEqual(stats.data[key].count, url_stats.count)
+                self.assertAlmostEqual(stats.data[key].time_sum, url_stats.time_sum)
+                self.assertEqual(stats.data[key].median(), url_stats.median())
+
+            # Без новых строк - отчет строится только по состоянию
+            stats = la.prepare_stats_incremental(log_path, state_path, 0.95)
+            self.assertEqual(stats.requests_total, expected.requests_total)
+
+            # Правила url поменялись: состояние не продолжается, лог разбирается заново без смешения ключей
+            url_rules = la.UrlRules(strip_query=False, template_ids=True, max_keys=0)
+            self.assertFalse(la.state_compatible(la.load_state(state_path), url_rules=url_rules))
+            stats = la.prepare_stats_incremental(log_path, state_path, 0.95, url_rules=url_rules)
+            self.assertEqual(stats.data.keys(), ['/api/v2/banner/{id}'])
+            self.assertEqual(stats.requests_total, expected.requests_total)
+            self.assertEqual(la.load_state(state_path)['url_rules'], [False, True, 0])
+
+            # Объединение за период пропускает дни, собранные с другими правилами
+            self.assertEqual(la.rollup_stats([state_path]).requests_total, 0)
+            self.assertEqual(la.rollup_stats([state_path], url_rules=url_rules).requests_total, 1000)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rollup(self):
+        """Тестирование отчета за период по сводным данным за дни"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            state_dir = os.path.join(tmpdir, 'state')
+            all_lines = []
+            for seed, date in enumerate(('20170625', '20170626', '20170703')):
+                log_path = os.path.join(tmpdir, 'nginx-test-ui.log-' + date)
+                lines = make_log_lines(500, seed=seed)
+                with open(log_path, 'w') as log:
+                    log.writelines(lines)
+                if date < '20170701':
+                    all_lines.extend(lines)
+                state_path = la.state_file_path(state_dir, os.path.basename(log_path))
+                if date == '20170626':
+                    # День, посчитанный через колоночный файл (AGGREGATOR = numpy)
+                    la.convert_log(log_path, log_path + '.col', 0.95)
+                    columns = la.load_columns(log_path + '.col')
+                    self.assertEqual(la.save_columns_state(columns, log_path, state_path), 500)
+                    state = la.load_state(state_path)
+                    self.assertTrue(la.state_compatible(state))
+                    self.assertEqual((state['offset'], state['processed']), (os.path.getsize(log_path), 500))
+                else:
+                    la.prepare_stats_incremental(log_path, state_path, 0.95)
+
+            days = la.find_state_files(state_dir, 'nginx-test-ui.log')
+            self.assertEqual(len(days), 3)
+
+            start, end, name = la.rollup_period('month', datetime.datetime(2017, 6, 26))
+            self.assertEqual((start.day, end.day, name), (1, 30, '2017.06'))
+            start, end, name = la.rollup_period('week', datetime.datetime(2017, 6, 28))
+            self.assertEqual((start.day, end.day, name), (26, 2, '2017.W26'))
+
+            start, end, name = la.rollup_period('month', datetime.datetime(2017, 6, 26))
+            stats = la.rollup_stats([days[day] for day in days if start <= day <= end])
+
+            with open(os.path.join(tmpdir, 'all.log'), 'w') as log:
+                log.writelines(all_lines)
+            expected = la.prepare_stats(la.read_lines(os.path.join(tmpdir, 'all.log'), 0.95))
+            self.assertEqual(stats.requests_total, expected.requests_total)
+            self.assertEqual(la.make_final_list(stats, 10), la.make_final_list(expected, 10))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_columnar(self):
+        """Тестирование колоночного формата"""
+
+        tmpdir = tempfile.mkdtemp()
+        numpy = la.np
+        try:
+            log_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623')
+            col_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623.col')
+            with open(log_path, 'w') as log:
+                log.writelines(make_log_lines(2000))
+
+            la.convert_log(log_path, col_path, 0.95)
+            expected = la.prepare_stats(la.read_lines(log_path, 0.95))
+
+            # С numpy (memmap) и без него (array)
+            for module in (numpy, None):
+                la.np = module
+                columns = la.load_columns(col_path)
+                self.assertEqual(columns['rows'], 2000)
+                self.assertEqual(len(columns['urls']), len(expected.data))
+                self.assertEqual(set(columns['status']), set([200]))
+
+                stats = la.stats_from_columns(columns)
+                self.assertEqual(stats.requests_total, expected.requests_total)
+                for key, url_stats in expected.data.iteritems():
+                    self.assertEqual(stats.data[key].count, url_stats.count)
+                    self.assertAlmostEqual(stats.data[key].time_max, url_stats.time_max, places=5)
+        finally:
+            la.np = numpy
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(la.np is None, "numpy is not installed")
+    def test_make_final_list_np(self):
+        """Тестирование расчета отчета средствами numpy: совпадает с make_final_list"""
+
+        lines = make_log_lines(3000, urls=60)
+        parsed = [la.project_line(line) for line in lines]
+        expected = la.make_final_list(la.prepare_stats(parsed), 1000)
+
+        url_ids = {}
+        ids = [url_ids.setdefault(request.split(' ')[1], len(url_ids)) for request, _ in parsed]
+        urls = sorted(url_ids, key=url_ids.get)
+        times = [float(request_time) for _, request_time in parsed]
+
+        self.assertEqual(la.make_final_list_np(urls, ids, times, 1000), expected)
+        self.assertEqual(la.make_final_list_np(urls, ids, times, 10), expected[:10])
+        self.assertEqual(la.make_final_list_np(urls, [], [], 10), [])
+
+        # Рабочий путь: колонки из convert_log/load_columns, время ответа - float32.
+        # Медиана make_final_list_np точная - сравнение в режиме exact (в hybrid на 1000 значений уже скетч)
+        tmpdir = tempfile.mkdtemp()
+        la.set_quantile_mode('exact')
+        try:
+            log_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623')
+            col_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623.col')
+            lines = make_log_lines(20000, urls=20)
+            # url с двумя запросами: медиана посередине соседних миллисекунд, float32 округляется иначе
+            template = lines[0].rsplit(' ', 1)[0].replace('/api/v2/banner/', '/api/v2/slot/')
+            for i, (first, second) in enumerate(((1.514, 1.515), (0.007, 0.008), (0.013, 0.014), (2.345, 2.346))):
+                lines.append(template.replace('/slot/', '/slot/%d/' % i) + ' %.3f\n' % first)
+                lines.append(template.replace('/slot/', '/slot/%d/' % i) + ' %.3f\n' % second)
+            with open(log_path, 'w') as log:
+                log.writelines(lines)
+            la.convert_log(log_path, col_path, 0.95)
+            columns = la.load_columns(col_path)
+            self.assertEqual(columns['request_time'].dtype, la.np.float32)
+
+            expected = la.make_final_list(la.prepare_stats(parse_log_lines(lines)), 1000)
+            self.assertEqual(la.make_final_list_np(columns['urls'], columns['url_id'], columns['request_time'], 1000),
+                             expected)
+            self.assertEqual(la.make_final_list(la.stats_from_columns(columns), 1000), expected)
+        finally:
+            la.set_quantile_mode('hybrid')
+            shutil.rmtree(tmpdir)
+
+    def test_make_final_list_top(self):
+        """Тестирование отбора url в отчет: совпадает с полной сортировкой, в том числе при равных time_sum"""
+
+        rnd = random.Random(3)
+        parsed = [('GET /url/%d HTTP/1.1' % rnd.randint(1, 40), rnd.choice(('0.100', '0.200', '0.300')))
+                  for _ in range(500)]
+        stats = la.prepare_stats(parsed)
+        full = la.make_final_list(stats, len(stats.data))
+        for report_size in (1, 5, 17, 40, 100):
+            self.assertEqual(la.make_final_list(stats, report_size), full[:report_size])
+
+        if la.np is not None:
+            keys = la.np.array([rnd.choice((1.0, 2.0, 3.0, 4.0)) for _ in range(200)])
+            stable = la.np.argsort(-keys, kind='mergesort')
+            for k in (1, 10, 50, 200, 300):
+                self.assertEqual(la.top_k_order(keys, k).tolist(), stable[:k].tolist())
+
+    def test_url_rules(self):
+        """Тестирование нормализации url и ограничения числа ключей"""
+
+        normalize = la.make_url_normalizer(la.UrlRules(strip_query=True, template_ids=True, max_keys=0))
+        self.assertEqual(normalize('/api/v2/banner/25019354?x=1'), '/api/v2/banner/{id}')
+        self.assertEqual(normalize('/api/1/slot/4705/groups'), '/api/{id}/slot/{id}/groups')
+        self.assertEqual(normalize('/export/2f1c3a4e-0b1d-4c5e-9f00-1234567890ab/'), '/export/{uuid}/')
+        self.assertEqual(normalize('/api/v2/banner25'), '/api/v2/banner25')
+
+        normalize = la.make_url_normalizer(la.UrlRules(strip_query=False, template_ids=True, max_keys=0))
+        self.assertEqual(normalize('/api/v2/banner/25?id=7'), '/api/v2/banner/{id}?id=7')
+        self.assertEqual(la.make_url_normalizer(la.UrlRules(strip_query=False, template_ids=False, max_keys=5)), None)
+
+        lines = make_log_lines(2000, urls=50)
+        stats = la.prepare_stats(parse_log_lines(lines), la.UrlRules(False, True, 0))
+        self.assertEqual(stats.data.keys(), ['/api/v2/banner/{id}'])
+
+        stats = la.prepare_stats(parse_log_lines(lines), la.UrlRules(False, False, 10))
+        self.assertEqual(len(stats.data), 11)
+        self.assertEqual(sum(url_stats.count for url_stats in stats.data.itervalues()), 2000)
+        self.assertTrue(stats.data[la.OTHER_URL].count > 0)
+
+        # Лимит действует и при слиянии частичных данных
+        merged = la.merge_stats(la.prepare_stats(parse_log_lines(lines[:1000]), la.UrlRules(False, False, 10)),
+                                la.prepare_stats(parse_log_lines(lines[1000:]), la.UrlRules(False, False, 10)), 10)
+        self.assertEqual(len(merged.data), 11)
+        self.assertEqual(merged.requests_total, 2000)
+
+    def test_dimensions(self):
+        """Тестирование разбивки по часу и классу статуса с квантилями в отчете"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            rnd = random.Random(2)
+            lines = [line.replace(':03:50:', ':%02d:50:' % rnd.randint(0, 3)).replace(
+                     ' 200 ', ' %s ' % rnd.choice(('200', '404', '502'))) for line in make_log_lines(3000, urls=5)]
+            log_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623')
+            with open(log_path, 'w') as log:
+                log.writelines(lines)
+
+            dimensions = la.dimensions_from_config({"DIMENSIONS": "hour, status"})
+            self.assertEqual(dimensions, ('hour', 'status'))
+            self.assertRaises(ValueError, la.dimensions_from_config, {"DIMENSIONS": "weekday"})
+
+            fields = la.stats_fields(dimensions)
+            stats = la.prepare_stats(la.read_lines(log_path, 0.95, fields), dimensions=dimensions)
+            self.assertEqual(len(stats.data), 5 * 4 * 3)
+            self.assertIn(('/api/v2/banner/1', '00', '5xx'), stats.data)
+            self.assertEqual(sum(url_stats.count for url_stats in stats.data.itervalues()), 3000)
+
+            # Тот же результат при чтении кусками в нескольких процессах, с сохранением состояния
+            state_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623.state.json.gz')
+            incremental = la.prepare_stats_incremental(log_path, state_path, 0.95, 2, dimensions=dimensions)
+            self.assertEqual(sorted(incremental.data), sorted(stats.data))
+            self.assertEqual(sorted(la.load_state(state_path)['stats'].data), sorted(incremental.data))
+
+            report = la.make_final_list(stats, 10, dimensions)
+            row = report[0]
+            self.assertTrue(row['url'].startswith('/api/v2/banner/'))
+            self.assertEqual(stats.data[(row['url'], row['hour'], row['status'])].count, row['count'])
+            self.assertTrue(row['time_med'] <= row['time_p95'] <= row['time_p99'] <= row['time_max'])
+            self.assertNotIn('time_p95', la.make_final_list(la.prepare_stats(parse_log_lines(lines)), 10)[0])
+
+            # Сводные данные без измерений не смешиваются с данными с измерениями
+            self.assertEqual(la.rollup_stats([state_path]).requests_total, 0)
+            self.assertEqual(la.rollup_stats([state_path], dimensions=dimensions).requests_total, 3000)
+
+            # Измерение с большим числом значений: лимит URL_MAX_KEYS действует на ключ целиком
+            lines = [line.replace('"dc7161be3"', '"user%d"' % i) for i, line in enumerate(make_log_lines(3000, urls=5))]
+            with open(log_path, 'w') as log:
+                log.writelines(lines)
+            dimensions = ('http_x_rb_user',)
+            url_rules = la.UrlRules(strip_query=False, template_ids=False, max_keys=10)
+            stats = la.prepare_stats(la.read_lines(log_path, 0.95, la.stats_fields(dimensions)), url_rules, dimensions)
+            self.assertEqual(len(stats.data), 11)
+            self.assertEqual(stats.data[(la.OTHER_URL, la.OTHER_URL)].count, 2990)
+            os.remove(state_path)
+            incremental = la.prepare_stats_incremental(log_path, state_path, 0.95, 2, url_rules, dimensions)
+            self.assertTrue(len(incremental.data) <= 11)
+            self.assertEqual(sum(url_stats.count for url_stats in incremental.data.itervalues()), 3000)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_log_follower(self):
+        """Тестирование чтения дописываемого лога с ротацией"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmpdir, 'nginx-test-ui.log')
+            lines = make_log_lines(100)
+            with open(log_path, 'w') as log:
+                log.writelines(lines[:10])
+
+            # Слежение начинается с конца файла, недописанная строка ждет продолжения
+            follower = la.LogFollower(log_path)
+            self.assertEqual(follower.read_lines(), [])
+            with open(log_path, 'a') as log:
+                log.writelines(lines[10:20])
+                log.write(lines[20][:30])
+            self.assertEqual(follower.read_lines(), lines[10:20])
+            with open(log_path, 'a') as log:
+                log.write(lines[20][30:])
+            self.assertEqual(follower.read_lines(), lines[20:21])
+
+            # logrotate: файл переименован, дописан и создан новый
+            os.rename(log_path, log_path + '.1')
+            with open(log_path + '.1', 'a') as log:
+                log.writelines(lines[21:30])
+            self.assertEqual(follower.read_lines(), lines[21:30])
+            with open(log_path, 'w') as log:
+                log.writelines(lines[30:40])
+            self.assertEqual(follower.read_lines(), lines[30:40])
+
+            # copytruncate: файл усечен и пишется с начала
+            with open(log_path, 'w') as log:
+                log.writelines(lines[40:45])
+            self.assertEqual(follower.read_lines(), lines[40:45])
+
+            # Переход на лог за новую дату
+            new_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170624')
+            with open(new_path, 'w') as log:
+                log.writelines(lines[50:60])
+            self.assertEqual(follower.switch(new_path), lines[50:60])
+            follower.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rolling_stats(self):
+        """Тестирование скользящих окон по минутам времени лога"""
+
+        lines = []
+        for minute, line in enumerate(make_log_lines(120, urls=5)):
+            lines.append(line.replace('03:50:22', '%02d:%02d:22' % (minute // 60, minute % 60)))
+        fields = la.stats_fields() + ('time_local',)
+        parsed = [la.project_line(line, fields) for line in lines]
+
+        rolling = la.RollingStats(60)
+        rolling.add(parsed[:100])
+        rolling.add(parsed[100:])
+        self.assertEqual(len(rolling.buckets), 60)
+
+        window = rolling.window(5)
+        expected = la.prepare_stats(parsed[-5:])
+        self.assertEqual(window.requests_total, 5)
+        self.assertAlmostEqual(window.time_total, expected.time_total)
+        self.assertEqual(la.make_final_list(window, 10), la.make_final_list(expected, 10))
+        self.assertEqual(la.make_final_list(rolling.window(60), 10),
+                         la.make_final_list(la.prepare_stats(parsed[-60:]), 10))
+
+        # Окна собираются из новых накопителей, корзины не меняются
+        self.assertEqual(rolling.window(5).requests_total, 5)
+
+    def test_save_report(self):
+        """Тестирование потоковой записи отчета в html и json"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            stats = la.prepare_stats(parse_log_lines(make_log_lines(1000)))
+            report = la.make_final_list(stats, 30)
+
+            # html совпадает с подстановкой json.dumps всего отчета в шаблон
+            html_path = la.save_report(la.iter_final_list(stats, 30), os.path.join(tmpdir, 'report.html'))
+            with open('report.html') as tmpl:
+                expected = tmpl.read().replace('$table_json', json.dumps(report))
+            with open(html_path) as html:
+                self.assertEqual(html.read(), expected)
+
+            json_path = la.write_report(iter(report), os.path.join(tmpdir, 'report.json.gz'), 'json.gz')
+            with gzip.open(json_path) as json_file:
+                self.assertEqual(json.load(json_file), report)
+
+            # Постраничная запись: оглавление и страницы
+            index_path = la.save_report_json(iter(report), os.path.join(tmpdir, 'report-2017.06.23.json'), 7)
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+            self.assertEqual(index['rows'], 30)
+            self.assertEqual(index['pages'][0], 'report-2017.06.23-0001.json')
+            rows = []
+            for page in index['pages']:
+                with open(os.path.join(tmpdir, page)) as page_file:
+                    rows.extend(json.load(page_file))
+            self.assertEqual(len(index['pages']), 5)
+            self.assertEqual(rows, report)
+
+            # Ошибка при расчете строк посреди записи: отчет не появляется, .tmp удаляется
+            def failing_rows():
+                for row in report[:10]:
+                    yield row
+                raise ZeroDivisionError("float division by zero")
+
+            failed_path = os.path.join(tmpdir, 'report-2017.06.29.html')
+            self.assertRaises(ZeroDivisionError, la.save_report, failing_rows(), failed_path)
+            self.assertFalse(os.path.exists(failed_path))
+            self.assertFalse(os.path.exists(failed_path + '.tmp'))
+            self.assertFalse(la.report_exists(failed_path))
+
+            # То же для json, целиком и постранично: не остается ни .tmp, ни записанных страниц
+            before = sorted(os.listdir(tmpdir))
+            for name, page_size in (('report-2017.06.29.json.gz', 0), ('report-2017.06.29.json', 4)):
+                failed_path = os.path.join(tmpdir, name)
+                self.assertRaises(ZeroDivisionError, la.save_report_json, failing_rows(), failed_path, page_size)
+                self.assertEqual(sorted(os.listdir(tmpdir)), before)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_mmap_lines(self):
+        """Тестирование разбора plain-лога через mmap: тот же результат, что и при построчном чтении"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623')
+            lines = make_log_lines(1000)
+            lines[10] = 'broken line\n'
+            lines[20] = lines[20].replace('" 2', '"  2').replace('\n', '\r\n')
+            # Начало и конец как у строки лога, но не те поля: не принимаются, как и при построчном чтении
+            lines[30] = 'garbage "GET /evil HTTP/1.1" junk" 9.999\n'
+            lines[40] = 'x "GET /evil HTTP/1.1" "a" "b" "c" "d" 1.5\n'
+            lines[50] = lines[50].replace('\n', ' \n')
+            with open(log_path, 'w') as log:
+                log.writelines(lines)
+                log.write(lines[0].rstrip('\n'))
+
+            expected = list(la.read_lines(log_path, 0.5))
+            self.assertNotIn('GET /evil HTTP/1.1', [request for request, request_time in expected])
+            counters = {'total': 0, 'processed': 0}
+            self.assertEqual(list(la.mmap_lines(log_path, counters)), expected)
+            self.assertEqual(counters, {'total': 1001, 'processed': 998})
+
+            # Диапазон байт и пустой диапазон
+            start = len(''.join(lines[:500]))
+            counters = {'total': 0, 'processed': 0}
+            self.assertEqual(list(la.mmap_lines(log_path, counters, start, start + len(lines[500]))), expected[497:498])
+            self.assertEqual(list(la.mmap_lines(log_path, counters, start, start)), [])
+
+            readers = la.readers_from_config(dict(la.config, PLAIN_READER='mmap'))
+            self.assertEqual(readers, la.Readers(plain='mmap', gzip='thread'))
+            self.assertRaises(ValueError, la.readers_from_config, dict(la.config, PLAIN_READER='mmmap'))
+            self.assertEqual(list(la.read_lines(log_path, 0.95, readers=readers)), expected)
+            stats = la.prepare_stats_parallel(log_path, 0.95, 2, readers)
+            self.assertEqual(la.make_final_list(stats, 10), la.make_final_list(la.prepare_stats(expected), 10))
+
+            # main читает лог способом из переданной конфигурации, а не из глобальной la.config
+            mmap_lines = la.mmap_lines
+            calls = []
+            la.mmap_lines = lambda *args: calls.append(args) or mmap_lines(*args)
+            try:
+                config = dict(la.config, LOG_DIR=tmpdir, FILE_PATTERN='nginx-test-ui.log', PLAIN_READER='mmap',
+                              REPORT_DIR=os.path.join(tmpdir, 'reports'), STATE_DIR=os.path.join(tmpdir, 'state'))
+                la.main(config)
+            finally:
+                la.mmap_lines = mmap_lines
+            self.assertEqual(la.config["PLAIN_READER"], 'lines')
+            self.assertEqual(len(calls), 1)
+            self.assertTrue(os.path.exists(os.path.join(tmpdir, 'reports', 'report-2017.06.23.html')))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_profile(self):
+        """Тестирование json-сводки замеров этапов и профилирования выборки строк"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            config = dict(la.config, LOG_DIR=os.path.join(tmpdir, 'log'), REPORT_DIR=os.path.join(tmpdir, 'reports'),
+                          STATE_DIR=os.path.join(tmpdir, 'state'), FILE_PATTERN='nginx-test-ui.log',
+                          PROFILE=os.path.join(tmpdir, 'profile.json'), PROFILE_SAMPLE=300)
+            os.makedirs(config["LOG_DIR"])
+            with gzip.open(os.path.join(config["LOG_DIR"], 'nginx-test-ui.log-20170623.gz'), 'wb') as log:
+                log.writelines(make_log_lines(1000))
+
+            la.main(config)
+            with open(config["PROFILE"]) as profile_file:
+                summary = json.load(profile_file)
+
+            self.assertEqual([stage['stage'] for stage in summary['stages']],
+                             ['prepare_stats', 'make_final_list', 'save_report'])
+            self.assertEqual(summary['stages'][0]['items'], 1000)
+            self.assertEqual(summary['stages'][1]['items'], 50)
+            for stage in summary['stages']:
+                self.assertTrue(stage['wall_s'] >= 0 and stage['peak_rss_kb'] > 0)
+                self.assertTrue(0 <= stage['rss_growth_kb'] <= stage['peak_rss_kb'])
+
+            sample = summary['sample']
+            self.assertEqual(sample['lines'], 300)
+            self.assertEqual([stage['stage'] for stage in sample['stages']],
+                             ['read_lines', 'process_line', 'prepare_stats'])
+            self.assertTrue(any('project_line' in func['function'] for func in sample['profile']))
+            self.assertTrue(os.path.exists(os.path.join(config["REPORT_DIR"], 'report-2017.06.23.html')))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_gzip_readers(self):
+        """Тестирование чтения gzip с распаковкой в отдельном потоке и процессе"""
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            gz_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170623.gz')
+            lines = make_log_lines(5000)
+
+            # Файл из нескольких gzip-членов (как после дописывания или склейки)
+            with open(gz_path, 'wb') as raw:
+                for part in (lines[:1000], lines[1000:1001], lines[1001:]):
+                    member_path = os.path.join(tmpdir, 'member.gz')
+                    with gzip.open(member_path, 'wb') as member:
+                        member.writelines(part)
+                    with open(member_path, 'rb') as member:
+                        raw.write(member.read())
+
+            block_size = la.GZIP_BLOCK_SIZE
+            la.GZIP_BLOCK_SIZE = 4096
+            try:
+                for reader in ('thread', 'process', 'simple'):
+                    log = la.open_log(gz_path, reader)
+                    self.assertEqual(list(log), lines)
+                    log.close()
+
+                    # Закрытие до конца файла не блокируется
+                    log = la.open_log(gz_path, reader)
+                    self.assertEqual(next(iter(log)), lines[0])
+                    log.close()
+
+                # Обрезанный файл: ошибка во всех режимах, а не часть строк
+                truncated_path = os.path.join(tmpdir, 'nginx-test-ui.log-20170624.gz')
+                with open(gz_path, 'rb') as raw:
+                    data = raw.read()
+                # gzip.open при обрезке внутри 8-байтного хвоста члена падает на struct.error - только thread и process
+                for size, readers in ((len(data) // 2, ('thread', 'process', 'simple')),
+                                      (len(data) - 4, ('thread', 'process'))):
+                    with open(truncated_path, 'wb') as raw:
+                        raw.write(data[:size])
+                    for reader in readers:
+                        log = la.open_log(truncated_path, reader)
+                        self.assertRaises(IOError, list, log)
+                        log.close()
+            finally:
+                la.GZIP_BLOCK_SIZE = block_size
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def make_log_lines(count, urls=50, seed=1):
+    """Синтетические строки лога в формате ui_short"""
+
+    rnd = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        lines.append('1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/%d HTTP/1.1" 200 927 "-" '
+                     '"Lynx/2.8.8dev.9 libwww-FM/2.14" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" %.3f\n'
+                     % (rnd.randint(1, urls), rnd.uniform(0.001, 3.0)))
+    return lines
+
+
+def parse_log_lines(lines):
+    """Пары (request, request_time) для prepare_stats"""
+
+    return [la.project_line(line) for line in lines]
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file